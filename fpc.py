@@ -14,17 +14,47 @@ It adds the following commandline arguments:
 -park             Park closed and verified candidates
 -auto             Do not ask before commiting edits to articles
 -dry              Do not submit any edits, just print them
--threads          Use threads to speed things up, can't be used in interactive mode
+-threads[:n]      Use a pool of n threads to speed things up (default max_external_links),
+                  can't be used in interactive mode
 -fpc              Handle the featured candidates (if neither -fpc or -delist is used all candidates are handled)
 -delist           Handle the delisting candidates (if neither -fpc or -delist is used all candidates are handled)
 -notime           Avoid displaying timestamps in log output
 -match pattern    Only operate on candidates matching this pattern
+-api:url          Send the batched API queries to url instead of through pywikibot,
+                  f.ex. a local stand-in of the API used for testing. Only then are the
+                  reads slowed down and retried by the bot itself when the servers are lagged
+-store:path       Database used to remember things between runs (default fpcbot.db next to this file)
+-speedup          Time -info with 1, 2, 4, 8 and 16 threads and report the speedup, each run
+                  starts without any stored pages
+-concurrency:n    Run up to n of the api reads done before checking the candidates at the same time
+-buildindex       Index which featured picture galleries list each file, used when delisting
+-votetest         Compare the vote counts of the vote matcher with those of the old vote
+                  regexps on an old log and time both on pages that make the regexps backtrack
+-daemon           Keep running, closing and parking candidates as soon as their pages are
+                  edited or they become old enough, must be run with -dry or -auto
+-appendtest       Check that the scans made from the lines added to a page are the
+                  same as the scans of the whole page on an old log and on generated pages
+-next             List when the candidates can be closed next, as found by the
+                  last -close or -daemon run, without using the network
+-feed:path        With -daemon read the edits from EventStreams recentchange events appended
+                  to the file path instead of polling the recent changes
+-dump:path        Run -test on the candidates found in a pages-articles or pages-meta-history
+                  xml dump (which may be bz2 compressed) instead of using the network
+-months:from[:to] With -dump the months of the logs to test, f.ex. 2009-01:2012-12 (default 2009-01)
+-procs[:n]        Run -test in n processes (default the number of cpus) on the candidates in the
+                  -dump, or without it on the candidates kept in the store, and summarize the
+                  results per year, the kinds of differences and the slowest pages
 """
 
-import pywikibot, re, datetime, sys, difflib, signal
+import pywikibot, re, datetime, sys, difflib, signal, collections, traceback
+import json, urllib, urllib2, os, sqlite3, random, heapq, HTMLParser, bz2, bisect, tempfile, shutil
+import xml.etree.cElementTree as ElementTree
+
+# Imports needed for the recounts in several processes
+import multiprocessing
 
 # Imports needed for threading
-import threading, time
+import threading, time, Queue
 from pywikibot import config
 
 # Import for single process check
@@ -34,15 +64,1631 @@ from tendo import singleton
 class NotImplementedException(Exception):
     """Not implemented"""
 
-class ThreadCheckCandidate(threading.Thread):
+class CandidatePool():
+    """
+    Runs a check on candidates using a fixed number of threads
+
+    The candidates are handed to the threads through a bounded queue.
+    The output and any exception of each check is collected, and
+    emitted in the order of the candidate list.
+    """
+
+    def __init__(self,workers):
+        self.workers = workers
+
+    def _work(self,check,tasks,results,done):
+        while True:
+            item = tasks.get()
+            if item is None:
+                return
+            i,candidate = item
+            G_Output.lines = []
+            error = None
+            try:
+                check(candidate)
+            except Exception:
+                error = sys.exc_info()
+            lines = G_Output.lines
+            G_Output.lines = None
+            with done:
+                results[i] = (lines,error)
+                done.notify()
+
+    def _feed(self,candidates,tasks,state):
+        for item in enumerate(candidates):
+            if G_Abort or state['failed']:
+                break
+            tasks.put(item)
+            state['fed'] += 1
+        state['feeding'] = False
+        for i in range(self.workers):
+            tasks.put(None)
+
+    def run(self,check,candidates):
+        """Calls check on each of the candidates"""
+        tasks   = Queue.Queue(maxsize=2*self.workers)
+        results = {}
+        done    = threading.Condition()
+        state   = {'fed':0, 'feeding':True, 'failed':False}
+
+        threads = [threading.Thread(target=self._work,args=(check,tasks,results,done))
+                   for i in range(self.workers)]
+        threads.append(threading.Thread(target=self._feed,args=(candidates,tasks,state)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        tot = len(candidates)
+        failure = None
+        i = 0
+        while True:
+            with done:
+                # Wait with a timeout, so we still see CTRL-C
+                while i not in results and (state['feeding'] or i < state['fed']):
+                    done.wait(0.5)
+                if i not in results:
+                    break
+                lines,error = results.pop(i)
+
+            out("(%03d/%03d) " %(i+1,tot), newline=False, date=True)
+            for line,newline in lines:
+                write(line,newline)
+            i += 1
+
+            if error:
+                if issubclass(error[0],pywikibot.NoPage):
+                    out("No such page '%s'" % error[1], color="lightred")
+                elif issubclass(error[0],pywikibot.LockedPage):
+                    out("Page is locked '%s'" % error[1], color="lightred")
+                elif not failure:
+                    # Stop handing out candidates and raise it when all threads are done
+                    state['failed'] = True
+                    failure = error
+
+        for thread in threads:
+            thread.join()
+
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+
+class PageCache():
+    """
+    Holds the raw and filtered text of every page fetched during a run
+
+    Pages are keyed by their title and remember the revision id
+    they were fetched at, a page is dropped again by invalidate()
+    which is done each time the bot commits a new version of it.
+    Pages that are not in the cache are loaded through the PageStore.
+    """
+
+    def __init__(self):
+        self._pages = {}    # title -> [revid,text,filtered text]
+        self._lock  = threading.Lock()
+        self.hits          = 0
+        self.misses        = 0
+        self.filterHits    = 0
+        self.filterMisses  = 0
+        self.invalidations = 0
+
+    def _entry(self,page):
+        """Returns the cache entry of page, fetching it if needed"""
+        title = page.title()
+        with self._lock:
+            entry = self._pages.get(title)
+            if entry:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        G_PageStore.load([title])
+
+        with self._lock:
+            # If the api did not tell us anything we treat it as missing
+            return self._pages.setdefault(title,[None,None,None])
+
+    def seed(self,title,revid,text):
+        """Add a page fetched elsewhere, text should be None for missing pages"""
+        with self._lock:
+            entry = self._pages.get(title)
+            if entry and entry[0] == revid and revid is not None:
+                return
+            self._pages[title] = [revid,text,None]
+
+    def get(self,page):
+        """Returns the text of page, raises pywikibot.NoPage just like page.get()"""
+        text = self._entry(page)[1]
+        if text is None:
+            raise pywikibot.NoPage(page)
+        return text
+
+    def filtered(self,page):
+        """Returns the text of page as given by filter_content()"""
+        entry = self._entry(page)
+        if entry[1] is None:
+            raise pywikibot.NoPage(page)
+        if entry[2] is None:
+            entry[2] = filter_content(entry[1])
+            self.filterMisses += 1
+        else:
+            self.filterHits += 1
+        return entry[2]
+
+    def exists(self,page):
+        """Check if page exists, fetches the page if it is not known already"""
+        return self._entry(page)[1] is not None
+
+    def revision(self,page):
+        """The revision id the cached text of page was fetched at"""
+        return self._entry(page)[0]
+
+    def invalidate(self,page):
+        """Forget page, the next access will fetch it again"""
+        with self._lock:
+            if self._pages.pop(page.title(),None):
+                self.invalidations += 1
+
+    def report(self):
+        """Console output of the cache statistics"""
+        out("Page cache: %d hits, %d fetches, %d invalidated, filter reused %d of %d" %
+            (self.hits, self.misses, self.invalidations,
+             self.filterHits, self.filterHits + self.filterMisses))
+
+
+class WikiApi():
+    """
+    Access to the MediaWiki API for the queries we run in batches
+
+    Normally the requests are made through pywikibot, but if an url
+    is given plain http requests are made to it instead. This is used
+    to run the bot against a local stand-in of the API.
+    """
+
+    def __init__(self,url=None):
+        self.url = url
+        self.requests = 0
+        self._token = None
+
+    def request(self,params):
+        """Submit one request, returns the decoded json answer"""
+        params = dict(params)
+        params.setdefault('action','query')
+        params['format'] = 'json'
+        return G_Scheduler.read(lambda: self._submit(params))
+
+    def _submit(self,params):
+        self.requests += 1
+        if self.url:
+            params.setdefault('maxlag',MaxLag)
+            data = urllib.urlencode([(k, v.encode('utf-8') if isinstance(v,unicode) else v) for k,v in params.items()])
+            return json.load(urllib2.urlopen(self.url,data))
+        else:
+            from pywikibot.data import api
+            try:
+                return api.Request(site=pywikibot.Site(), **params).submit()
+            except api.APIError, error:
+                # Same as what we get from the api directly
+                return {'error':{'code':error.code,'info':error.info}}
+
+    def token(self):
+        """The token needed to edit"""
+        if not self._token:
+            if self.url:
+                self._token = self.request({'meta':'tokens'})['query']['tokens']['csrftoken']
+            else:
+                site = pywikibot.Site()
+                self._token = site.token(pywikibot.Page(site,"Main Page"),"edit")
+        return self._token
+
+    def edit(self,title,summary,**params):
+        """
+        Saves a page through action=edit, params are passed on to the api. The edit is
+        flagged as a bot edit if the account may do that, and the page is watched.
+        It is made when G_Scheduler allows it, and made again if the servers are lagged.
+        Returns the result of the edit, raises pywikibot.EditConflict if the page
+        changed since params['baserevid'] or was created when we wanted to create it,
+        pywikibot.LockedPage if it is protected and pywikibot.NoPage if it is gone.
+        """
+        params.update(action='edit',title=title,summary=summary,bot=1,watchlist='watch',token=self.token())
+        params['assert'] = 'user'
+        result = G_Scheduler.write(lambda: self._submit(params))
+        code = result.get('error',{}).get('code')
+        if code in ('editconflict','articleexists'):
+            raise pywikibot.EditConflict(title)
+        elif code in ('protectedpage','cascadeprotected','protectedtitle'):
+            raise pywikibot.LockedPage(title)
+        elif code == 'missingtitle':
+            raise pywikibot.NoPage(title)
+        elif code:
+            raise pywikibot.Error("API error %s: %s" % (code,result['error'].get('info')))
+        return result['edit']
+
+    def query(self,**params):
+        """
+        Runs a query and follows any continuation,
+        yields the 'query' part of each answer
+        """
+        cont = {'continue':''}
+        while True:
+            params.update(cont)
+            result = self.request(params)
+            if 'error' in result:
+                raise pywikibot.Error("API error %s: %s" % (result['error'].get('code'),result['error'].get('info')))
+            if 'query' in result:
+                yield result['query']
+            if 'continue' not in result:
+                return
+            cont = result['continue']
+
+    def queryPages(self,titles,**params):
+        """
+        Runs a prop query on titles, ApiBatchSize titles at a time.
+        Yields a (title,page) tuple for each of the requested titles, where page
+        is the dict returned by the api. Normalized titles are mapped back
+        to the title that was asked for.
+        """
+        titles = list(titles)
+        for result in concurrentMap(lambda batch: self._queryBatch(batch,params),batches(titles)):
+            for item in result:
+                yield item
+
+    def _queryBatch(self,batch,params):
+        """Runs the query for one batch of queryPages(), returns a list of (title,page)"""
+        pages = {}
+        asked = {}
+        for q in self.query(titles="|".join(batch), **params):
+            for n in q.get('normalized',[]):
+                asked[n['to']] = n['from']
+            for page in q.get('pages',{}).values():
+                # With continuation the same page can come back several times
+                if page['title'] in pages:
+                    for k,v in page.items():
+                        if isinstance(v,list):
+                            pages[page['title']].setdefault(k,[]).extend(v)
+                else:
+                    pages[page['title']] = page
+        return [(asked.get(title,title),page) for title,page in pages.items()]
+
+
+class RequestScheduler():
+    """
+    Decides when the requests to the wiki are made
+
+    Reads run with an adaptive limit on how many may be made at the
+    same time. The limit is halved each time the servers report that
+    they are lagged or busy, and grows back by about one for each
+    round of successful requests. Such reads are retried after a
+    backoff with some jitter. Writes are spaced by a token bucket, and
+    retried the same way.
+
+    Through pywikibot, that is without -api:url, pywikibot sends maxlag
+    and waits for lagged or busy servers itself, so only the limit on
+    the number of reads at the same time applies. The requests pywikibot
+    makes for us, such as getReferences() when there is no gallery index,
+    are not seen by the scheduler at all.
+    """
+
+    def __init__(self):
+        self.limit   = None     # Current read limit, starts at the max
+        self.active  = 0
+        self.tokens  = WriteBurst
+        self._refill = time.time()
+        self._cond   = threading.Condition()
+        self.started = None
+        self.reads   = 0
+        self.writes  = 0
+        self.retries = 0
+
+    def maxLimit(self):
+        """The most reads we allow at the same time"""
+        return max(G_Concurrency,G_Threads,1)
+
+    def _acquire(self):
+        with self._cond:
+            if self.started is None:
+                self.started = time.time()
+            if self.limit is None:
+                self.limit = float(self.maxLimit())
+            while self.active >= int(self.limit):
+                self._cond.wait(0.5)
+            self.active += 1
+
+    def _release(self,lagged):
+        with self._cond:
+            self.active -= 1
+            if lagged:
+                self.limit = max(1.0,self.limit / 2)
+            else:
+                self.limit = min(float(self.maxLimit()),self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _try(self,submit,last):
+        """
+        Calls submit(), returns what it returned and how long the servers asked us
+        to wait before trying again, or None for that if they did not ask
+        """
+        try:
+            result = submit()
+        except urllib2.HTTPError, error:
+            if error.code not in (429,503) or last:
+                raise
+            return None,float(error.headers.get('Retry-After',0) or 0)
+        error = result.get('error',{}) if isinstance(result,dict) else {}
+        if error.get('code') in ('maxlag','ratelimited'):
+            return result,float(error.get('lag',0))
+        return result,None
+
+    def _backoff(self,delay,attempt):
+        """Exponential backoff with jitter, but at least what the server asked for"""
+        self.retries += 1
+        time.sleep(max(delay,2 ** attempt) * random.uniform(0.5,1.5))
+
+    def read(self,submit):
+        """Calls submit() to make a read, returns what it returned"""
+        for attempt in range(MaxRetries + 1):
+            self._acquire()
+            delay = None
+            try:
+                result,delay = self._try(submit,attempt == MaxRetries)
+            finally:
+                self._release(lagged = delay is not None)
+
+            if delay is None or attempt == MaxRetries:
+                self.reads += 1
+                return result
+            self._backoff(delay,attempt)
+
+    def _token(self):
+        """Waits for a write token"""
+        with self._cond:
+            rate = 1.0 / max(getattr(config,'put_throttle',10),0.1)
+            while True:
+                now = time.time()
+                self.tokens = min(WriteBurst,self.tokens + (now - self._refill) * rate)
+                self._refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self._cond.wait((1 - self.tokens) / rate)
+
+    def write(self,submit):
+        """Calls submit() to make a write when a write token is free, returns what it returned"""
+        for attempt in range(MaxRetries + 1):
+            self._token()
+            self.writes += 1
+            result,delay = self._try(submit,attempt == MaxRetries)
+            if delay is None or attempt == MaxRetries:
+                return result
+            self._backoff(delay,attempt)
+
+    def report(self):
+        """Console output of the throughput we got"""
+        elapsed = time.time() - self.started if self.started else 0
+        out("Requests: %d reads (%.1f/s), %d writes, %d retries, read limit %d of %d" %
+            (self.reads, self.reads / max(elapsed,0.001), self.writes, self.retries,
+             int(self.limit or self.maxLimit()), self.maxLimit()))
+
+
+class PageStore():
+    """
+    Keeps the text of pages between runs, keyed by title and revision id
+
+    Before downloading pages we ask for their current revision ids in
+    bulk, and only pages that changed since they were stored are
+    downloaded again. For large pages we first ask for the diff of the
+    changes, if lines were just added at the end that is all we need.
+    The scans of candidate pages are kept along with their text and the
+    revision they were made at, such that unchanged candidates need no
+    rescan and for the others only what was added has to be scanned.
+    """
+
+    def __init__(self,store):
+        self._store = store
+        store.table("pages","CREATE TABLE IF NOT EXISTS pages "
+                            "(title TEXT PRIMARY KEY, revid INTEGER, text TEXT, scan TEXT)")
+        self._appended  = {}    # title -> (old revid,old text,revid,appended text)
+        self.reused     = 0
+        self.downloaded = 0
+        self.patched    = 0
+
+    def _stored(self,titles):
+        """Returns a dict title -> (revid,text) of the stored pages among titles"""
+        stored = {}
+        for batch in batches(titles,500):
+            rows = self._store.execute("SELECT title,revid,text FROM pages WHERE title IN (%s)" %
+                                       ",".join("?" * len(batch)), batch)
+            for title,revid,text in rows:
+                stored[title] = (revid,text)
+        return stored
+
+    def load(self,titles):
+        """
+        Adds the current text of all pages in titles to the page cache,
+        only downloading the pages that changed since they were stored.
+        This also gives us the latest revisions of the pages.
+        """
+        titles = [t for t in set(titles) if t]
+
+        current = {}
+        for title,page in G_Api.queryPages(titles,prop='revisions',rvprop='ids|timestamp|user'):
+            if 'missing' in page or 'invalid' in page or not page.get('revisions'):
+                G_PageCache.seed(title,None,None)
+            else:
+                rev = page['revisions'][0]
+                G_Revisions.seed(title,rev)
+                current[title] = rev['revid']
+
+        stored  = self._stored(current.keys())
+        changed = []
+        grown   = []
+        for title,revid in current.items():
+            if title in stored and stored[title][0] == revid:
+                G_PageCache.seed(title,revid,stored[title][1])
+                self.reused += 1
+            elif title in stored and len(stored[title][1]) >= DiffMinSize:
+                grown.append((title,stored[title],revid))
+            else:
+                changed.append(title)
+
+        patched = []
+        for (title,(oldrev,old),revid),appended in zip(grown,concurrentMap(self._fetchAppended,grown)):
+            if appended is None:
+                changed.append(title)
+                continue
+            G_PageCache.seed(title,revid,old + appended)
+            self._appended[title] = (oldrev,old,revid,appended)
+            patched.append((revid,old + appended,title))
+            self.patched += 1
+
+        downloaded = []
+        for title,page in G_Api.queryPages(changed,prop='revisions',rvprop='ids|content',rvslots='main'):
+            if page.get('revisions'):
+                rev  = page['revisions'][0]
+                text = revisionText(rev)
+                G_PageCache.seed(title,rev['revid'],text)
+                downloaded.append((title,rev['revid'],text))
+                self.downloaded += 1
+
+        # The scan of a patched page is kept, it is for the old revision
+        self._store.write([("UPDATE pages SET revid=?, text=? WHERE title=?",patched),
+                           ("INSERT OR REPLACE INTO pages VALUES (?,?,?,NULL)",downloaded)])
+
+    def pages(self,prefix):
+        """Yields (title,revid,text) for the stored pages with titles starting with prefix"""
+        titles = [title for title, in self._store.execute("SELECT title FROM pages WHERE title >= ? AND title < ? ORDER BY title",
+                                                          (prefix,prefix + u"\uffff"))]
+        for batch in batches(titles,100):
+            rows = self._store.execute("SELECT title,revid,text FROM pages WHERE title IN (%s) ORDER BY title" %
+                                       ",".join("?" * len(batch)), batch)
+            for row in rows:
+                yield row
+
+    def _fetchAppended(self,item):
+        """
+        The text appended to a stored page as found from the diff to its current
+        revision, item is a (title,(stored revid,stored text),current revid) tuple.
+        None if the edits did more than adding lines at the end.
+        """
+        title,(oldrev,old),revid = item
+        result = G_Api.request({'action':'compare','fromrev':oldrev,'torev':revid,'prop':'diff|size'})
+        compare = result.get('compare')
+        if not compare:
+            return None
+        appended = appendedText(old,compare.get('*',compare.get('body')))
+        # The sizes are in bytes, if they do not add up we did not read the diff right
+        if appended is None or len((old + appended).encode('utf-8')) != compare.get('tosize'):
+            return None
+        return appended
+
+    def _storedScan(self,title):
+        """The stored (revid,CandidateScan) of title, None if there is none"""
+        rows = self._store.execute("SELECT scan FROM pages WHERE title=?",(title,))
+        if not rows or not rows[0][0]:
+            return None
+        scan = json.loads(rows[0][0])
+        if scan[0] != ScanVersion:
+            return None
+        return scan[1],CandidateScan(*[asTuple(f) for f in scan[2]])
+
+    def scan(self,title,revid):
+        """The stored CandidateScan of title at revid, None if there is none"""
+        stored = self._storedScan(title)
+        if not stored or stored[0] != revid:
+            return None
+        return stored[1]
+
+    def previous(self,title,revid):
+        """
+        If title at revid was found by adding lines at the end of the revision
+        of the stored scan, returns a (scan,text,appended) tuple with that scan,
+        the text it was made from and the text that was appended. Otherwise None.
+        """
+        appended = self._appended.get(title)
+        if not appended or appended[2] != revid:
+            return None
+        stored = self._storedScan(title)
+        if not stored or stored[0] != appended[0]:
+            return None
+        return stored[1],appended[1],appended[3]
+
+    def saveScan(self,title,revid,scan):
+        """Keep the scan of title at revid"""
+        self._store.execute("UPDATE pages SET scan=? WHERE title=? AND revid=?",
+                            (json.dumps([ScanVersion,revid,scan]),title,revid))
+
+    def report(self):
+        """Console output of the store statistics"""
+        out("Page store: %d unchanged pages reused, %d downloaded, %d updated from a diff" %
+            (self.reused,self.downloaded,self.patched))
+
+
+class PatternCache():
+    """
+    The compiled regexps that are built from titles and tags at run time
+
+    Holds up to size patterns, the least recently used one is dropped
+    when a new pattern does not fit. Unlike the cache of the re module
+    it is not emptied when it gets full and looking up a pattern does
+    not need to check its type and flags first.
+    """
+
+    def __init__(self,size):
+        self.size    = size
+        self._cache  = collections.OrderedDict()
+        self._lock   = threading.Lock()
+        self.hits    = 0
+        self.misses  = 0
+
+    def compile(self,pattern,flags=0):
+        """Returns pattern compiled with flags, like re.compile()"""
+        key = (pattern,flags)
+        with self._lock:
+            regex = self._cache.pop(key,None)
+            if regex is not None:
+                self.hits += 1
+                self._cache[key] = regex
+                return regex
+            self.misses += 1
+
+        regex = re.compile(pattern,flags)
+        with self._lock:
+            self._cache[key] = regex
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return regex
+
+    def report(self):
+        """Console output of how well the cache worked"""
+        out("Patterns: %d compiled, %d reused" % (self.misses,self.hits))
+
+
+class Store():
+    """
+    The sqlite database where the bot keeps what it
+    needs to remember between runs.
+
+    The database is opened on first use and is shared
+    by all threads. The classes keeping something in it
+    declare their tables with table(), these are created
+    when the database is opened.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self._db  = None
+        self._tables = collections.OrderedDict()   # name -> statements creating it
+        self.lock = threading.RLock()
+
+    def table(self,name,*ddl):
+        """Declare the table name, ddl are the statements creating it and its indexes"""
+        with self.lock:
+            if name in self._tables:
+                return
+            self._tables[name] = ddl
+            if self._db:
+                self._create(ddl)
+
+    def _create(self,ddl):
+        for sql in ddl:
+            self._db.execute(sql)
+        self._db.commit()
+
+    def _open(self):
+        if not self._db:
+            self._db = sqlite3.connect(self.path,check_same_thread=False)
+            for ddl in self._tables.values():
+                self._create(ddl)
+        return self._db
+
+    def execute(self,sql,args=()):
+        """Execute one statement, returns all rows of the result"""
+        with self.lock:
+            rows = self._open().execute(sql,args).fetchall()
+            if not sql.lstrip().upper().startswith("SELECT"):
+                self._db.commit()
+            return rows
+
+    def executemany(self,sql,args):
+        """Execute one statement for each item in args"""
+        self.write([(sql,args)])
+
+    def write(self,statements):
+        """Execute each (sql,args) of statements for each item of its args, all in one transaction"""
+        with self.lock:
+            db = self._open()
+            try:
+                for sql,args in statements:
+                    db.executemany(sql,args)
+            except Exception:
+                db.rollback()
+                raise
+            db.commit()
+
+
+class RevisionInfo():
+    """
+    The first and the latest revision of pages, as (timestamp,user) tuples
+
+    The first revision never changes so it is kept in the store
+    between runs, after that we only need to look it up for new pages.
+    The latest revision is only kept for the current run.
+    """
+
+    def __init__(self,store):
+        self._store  = store
+        self._first  = {}
+        self._latest = {}
+        store.table("first_revisions","CREATE TABLE IF NOT EXISTS first_revisions "
+                                      "(title TEXT PRIMARY KEY, timestamp TEXT, user TEXT)")
+
+    def seed(self,title,rev):
+        """
+        Add the latest revision of title, rev is a revision dict from the api
+        with ids, timestamp and user. If it is the only revision of the page
+        it is the first revision as well.
+        """
+        info = (parseTimestamp(rev['timestamp']),rev.get('user',"Unknown"))
+        self._latest[title] = info
+        if rev.get('parentid') == 0 and title not in self._first:
+            self._setFirst(title,info)
+
+    def _setFirst(self,title,info):
+        self._first[title] = info
+        self._store.execute("INSERT OR REPLACE INTO first_revisions VALUES (?,?,?)",
+                            (title,info[0].strftime(TimestampFormat),info[1]))
+
+    def _knownFirst(self,titles):
+        """Loads what the store knows, returns the titles it has no first revision of"""
+        unknown = [t for t in titles if t not in self._first]
+        for batch in batches(unknown,500):
+            rows = self._store.execute("SELECT title,timestamp,user FROM first_revisions WHERE title IN (%s)" %
+                                       ",".join("?" * len(batch)), batch)
+            for title,ts,user in rows:
+                self._first[title] = (parseTimestamp(ts),user)
+        return [t for t in unknown if t not in self._first]
+
+    def load(self,titles):
+        """
+        Makes sure the first and latest revisions of titles are known.
+
+        The latest revisions are fetched in batches. The api can only return
+        the first revision of one page per query, so that is only done
+        for pages that are neither in the store nor have just one revision.
+        """
+        titles = [t for t in set(titles) if t]
+        missing = [t for t in titles if t not in self._latest]
+        for title,page in G_Api.queryPages(missing,prop='revisions',rvprop='ids|timestamp|user'):
+            if page.get('revisions'):
+                self.seed(title,page['revisions'][0])
+
+        concurrentMap(self._fetchFirst,[t for t in self._knownFirst(titles) if t in self._latest])
+
+    def _fetchFirst(self,title):
+        # No continuation here, that would walk the whole history
+        result = G_Api.request({'prop':'revisions','titles':title,'rvprop':'timestamp|user',
+                                'rvdir':'newer','rvlimit':1})
+        for page in result.get('query',{}).get('pages',{}).values():
+            if page.get('revisions'):
+                rev = page['revisions'][0]
+                self._setFirst(title,(parseTimestamp(rev['timestamp']),rev.get('user',"Unknown")))
+
+    def first(self,title):
+        """The first revision of title, or None if the page has no history"""
+        if title not in self._first and self._knownFirst([title]):
+            self._fetchFirst(title)
+        return self._first.get(title)
+
+    def stored(self,title):
+        """The first revision of title if we know it, it is never fetched"""
+        self._knownFirst([title])
+        return self._first.get(title)
+
+    def latest(self,title):
+        """The latest revision of title, or None if the page has no history"""
+        if title not in self._latest:
+            self.load([title])
+        return self._latest.get(title)
+
+    def invalidate(self,title):
+        """Forget the latest revision of title after editing it"""
+        self._latest.pop(title,None)
+
+
+class PageExistence():
+    """
+    Knows whether pages exist
+
+    The titles are resolved in batches, following normalisation
+    and redirects, such that checking a single title later on
+    is just a lookup.
+    """
+
+    def __init__(self):
+        self._exists = {}
+        self._lock   = threading.Lock()
+
+    def resolve(self,titles):
+        """Find out whether the pages in titles exist, ApiBatchSize titles per query"""
+        titles = [t for t in set(titles) if t and t not in self._exists]
+        concurrentMap(self._resolveBatch,batches(titles))
+
+    def _resolveBatch(self,batch):
+        renamed = {}
+        found   = {}
+        for q in G_Api.query(titles="|".join(batch),redirects=''):
+            for n in q.get('normalized',[]) + q.get('redirects',[]):
+                renamed[n['from']] = n['to']
+            for page in q.get('pages',{}).values():
+                found[page['title']] = 'missing' not in page and 'invalid' not in page
+        with self._lock:
+            for title in batch:
+                target = title
+                # Follow the chain of normalisations and redirects
+                for i in range(len(renamed)):
+                    if target not in renamed:
+                        break
+                    target = renamed[target]
+                self._exists[title] = found.get(target,False)
+
+    def exists(self,title):
+        """Check if the page title exists"""
+        if title not in self._exists:
+            self.resolve([title])
+        return self._exists.get(title,False)
+
+    def created(self,title):
+        """Note that the bot just saved the page title"""
+        with self._lock:
+            self._exists[title] = True
+
+
+class UserInfo():
+    """
+    Whether the voters exist, when they registered and their edit count
+
+    All voters are looked up together with list=users queries of
+    ApiBatchSize names, what we get is kept in the store for
+    UserInfoDays such that a run only asks for the new voters.
+    """
+
+    def __init__(self,store):
+        self._store = store
+        self._users = {}  # name -> (exists,registration,edit count)
+        self._lock  = threading.Lock()
+        store.table("users","CREATE TABLE IF NOT EXISTS users "
+                            "(name TEXT PRIMARY KEY, present INTEGER, registration TEXT, "
+                            "editcount INTEGER, fetched TEXT)")
+
+    def load(self,names):
+        """Look up the users that we don't know, from the store or else from the api"""
+        names = sorted(set(n for n in names if n and n not in self._users))
+        fresh = (datetime.datetime.utcnow() - datetime.timedelta(days=UserInfoDays)).strftime(TimestampFormat)
+        for batch in batches(names):
+            rows = self._store.execute("SELECT name,present,registration,editcount FROM users WHERE fetched >= ? AND name IN (%s)" %
+                                       ",".join("?" * len(batch)),[fresh] + batch)
+            for name,present,registration,editcount in rows:
+                self._set(name,(present,registration,editcount))
+
+        unknown = [n for n in names if n not in self._users]
+        concurrentMap(self._fetch,batches(unknown))
+
+    def _set(self,name,row):
+        present,registration,editcount = row
+        with self._lock:
+            self._users[name] = (bool(present),parseTimestamp(registration) if registration else None,editcount)
+
+    def _fetch(self,batch):
+        rows = []
+        now = datetime.datetime.utcnow().strftime(TimestampFormat)
+        for q in G_Api.query(list='users',ususers="|".join(batch),usprop='registration|editcount'):
+            for user in q.get('users',[]):
+                present = 'missing' not in user and 'invalid' not in user
+                # Very old accounts have no registration date
+                row = (int(present),user.get('registration'),user.get('editcount',0))
+                self._set(user['name'],row)
+                rows.append((user['name'],) + row + (now,))
+        self._store.executemany("INSERT OR REPLACE INTO users VALUES (?,?,?,?,?)",rows)
+
+    def known(self,name):
+        """Check if the user has been looked up"""
+        return name in self._users
+
+    def ineligible(self,name,since):
+        """
+        Why the user may not vote on a nomination created at since,
+        None if the user may vote or has not been looked up.
+        """
+        info = self._users.get(name)
+        if not info:
+            return None
+        present,registration,editcount = info
+        if not present:
+            return "no such user"
+        if editcount < MinVoterEdits:
+            return "%d edits" % editcount
+        if registration and registration > since - datetime.timedelta(days=MinVoterAgeDays):
+            return "registered %s" % registration.strftime("%Y-%m-%d")
+        return None
+
+
+class ParkJournal():
+    """
+    Remembers which steps of the parking procedure have been done
+
+    Before a step edits a page its intent is written to the store and
+    once the edit is saved the step is marked as done together with
+    the new revision id. A run that was interrupted, by Ctrl-C or
+    otherwise, can then skip the steps that are done without looking
+    at the pages again, only the steps that were started but not
+    finished need to check their pages.
+    """
+
+    def __init__(self,store):
+        self._store = store
+        store.table("park_journal","CREATE TABLE IF NOT EXISTS park_journal "
+                                   "(candidate TEXT, step TEXT, state TEXT, revid INTEGER, time TEXT, "
+                                   "PRIMARY KEY (candidate,step))")
+
+    def _set(self,candidate,step,state,revid=None):
+        self._store.execute("INSERT OR REPLACE INTO park_journal VALUES (?,?,?,?,?)",
+                            (candidate,step,state,revid,datetime.datetime.utcnow().strftime(TimestampFormat)))
+
+    def intend(self,candidate,step):
+        """Note that step of candidate is about to be done"""
+        if not G_Dry:
+            self._set(candidate,step,'intent')
+
+    def done(self,candidate,step,revid=None):
+        """Note that step of candidate is done, revid is the revision it saved if any"""
+        self._set(candidate,step,'done',revid)
+
+    def isDone(self,candidate,step):
+        """Check if step of candidate was done in this or an earlier run"""
+        return bool(self._store.execute("SELECT 1 FROM park_journal WHERE candidate=? AND step=? AND state='done'",
+                                        (candidate,step)))
+
+    def report(self):
+        """Console output of the steps that were started but not finished"""
+        for candidate,step in self._store.execute("SELECT candidate,step FROM park_journal WHERE state='intent' ORDER BY time"):
+            out("Unfinished: %s for '%s', will be checked on the next run" % (step,candidate), color="lightyellow")
+
+
+class Deadlines():
+    """
+    When each candidate has to be checked for closing again
+
+    A nomination can only be closed once it is five or nine days old,
+    or a day after the last edit if it was withdrawn or FPXed, see
+    Candidate.nextCheck(). Until the next of those times checking it
+    again gives the same result, unless the page was edited, so we keep
+    that time together with the revision it was found for. They are
+    kept in the store and in a heap, such that the candidates that
+    are due can be taken from the front of it.
+    """
+
+    def __init__(self,store):
+        self._store = store
+        store.table("deadlines","CREATE TABLE IF NOT EXISTS deadlines "
+                                "(candidate TEXT PRIMARY KEY, due TEXT, rule TEXT, revid INTEGER, list TEXT)")
+        self._lock  = threading.RLock()
+        self._due   = None      # candidate -> (time,rule,revid,candidate list), time is None if all passed
+        self._heap  = []        # (time,candidate), entries that are no longer in _due are skipped
+
+    def _load(self):
+        """Read the deadlines from the store the first time they are needed"""
+        if self._due is not None:
+            return
+        self._due = {}
+        for candidate,due,rule,revid,page in self._store.execute("SELECT candidate,due,rule,revid,list FROM deadlines"):
+            self._due[candidate] = (parseTimestamp(due) if due else None,rule,revid,page)
+        self._heap = [(due[0],candidate) for candidate,due in self._due.items() if due[0]]
+        heapq.heapify(self._heap)
+
+    def set(self,candidate,revid,page,due):
+        """
+        Remember the next deadline of candidate found at revid,
+        due is a (time,rule) tuple as given by Candidate.nextCheck()
+        """
+        time,rule = due or (None,None)
+        with self._lock:
+            self._load()
+            self._due[candidate] = (time,rule,revid,page)
+            if time:
+                heapq.heappush(self._heap,(time,candidate))
+            self._store.execute("INSERT OR REPLACE INTO deadlines VALUES (?,?,?,?,?)",
+                                (candidate,time.strftime(TimestampFormat) if time else None,rule,revid,page))
+
+    def isDue(self,candidate,revid,now=None):
+        """
+        Check if candidate at revid needs to be checked, that is if we do not know it,
+        it was edited since, its deadline has passed or it has no deadline left
+        """
+        with self._lock:
+            self._load()
+            due = self._due.get(candidate)
+        return not due or due[2] != revid or not due[0] or due[0] <= (now or datetime.datetime.utcnow())
+
+    def popDue(self,now=None):
+        """The candidates whose deadline has passed since the last call, earliest first"""
+        now = now or datetime.datetime.utcnow()
+        found = []
+        with self._lock:
+            self._load()
+            while self._heap and self._heap[0][0] <= now:
+                time,candidate = heapq.heappop(self._heap)
+                if self._due.get(candidate,(None,))[0] == time and candidate not in found:
+                    found.append(candidate)
+        return found
+
+    def keepOnly(self,page,candidates):
+        """Forget the candidates of the candidate list page that are not in candidates"""
+        candidates = set(candidates)
+        with self._lock:
+            self._load()
+            gone = [c for c,due in self._due.items() if due[3] == page and c not in candidates]
+            for candidate in gone:
+                del self._due[candidate]
+            for batch in batches(gone,500):
+                self._store.execute("DELETE FROM deadlines WHERE candidate IN (%s)" % ",".join("?" * len(batch)), batch)
+
+    def listing(self):
+        """Console output of the coming deadlines, as found by the last run"""
+        with self._lock:
+            self._load()
+            coming = sorted((due[0],candidate,due[1]) for candidate,due in self._due.items() if due[0])
+            passed = len(self._due) - len(coming)
+
+        now = datetime.datetime.utcnow()
+        out("Due (UTC)         In        Rule                       Candidate")
+        for time,candidate,rule in coming:
+            left = time - now
+            if left.days < 0:
+                left = "now"
+            else:
+                left = "%dd %02dh" % (left.days,left.seconds // 3600)
+            out("%s  %-8s  %-25s  %s" % (time.strftime("%Y-%m-%d %H:%M"),left,rule,candidate.replace(candPrefix,"")))
+        out("%d candidates are checked on every run as they have no deadline left" % passed)
+
+
+class GalleryIndex():
+    """
+    Which featured picture galleries list a file
+
+    Maps every featured file to the 'Commons:Featured pictures/...'
+    pages, the chronological ones included, that show it. The index is
+    built by crawling the galleries with -buildindex, which only reads
+    the galleries again that changed since the last time, and is kept
+    up to date by our own edits of them. Delisting then knows the pages
+    to change without asking for the references of the file.
+    """
+
+    def __init__(self,store):
+        self._store = store
+        store.table("gallery_pages","CREATE TABLE IF NOT EXISTS gallery_pages "
+                                    "(page TEXT PRIMARY KEY, revid INTEGER)",
+                                    "CREATE TABLE IF NOT EXISTS gallery_files "
+                                    "(file TEXT, page TEXT, PRIMARY KEY (file,page))",
+                                    "CREATE INDEX IF NOT EXISTS gallery_files_page ON gallery_files (page)")
+
+    def built(self):
+        """Check if -buildindex has been run"""
+        return bool(self._store.execute("SELECT 1 FROM gallery_pages LIMIT 1"))
+
+    def build(self):
+        """Index all the featured picture galleries"""
+        titles = []
+        for q in G_Api.query(list='allpages',apnamespace=4,apprefix=GalleryPrefix.split(':',1)[1],aplimit='max'):
+            titles.extend(page['title'] for page in q.get('allpages',[]))
+        known = dict(self._store.execute("SELECT page,revid FROM gallery_pages"))
+
+        G_PageStore.load(titles)
+        changed = 0
+        for title in titles:
+            page = pywikibot.Page(pywikibot.Site(),title)
+            try:
+                text = G_PageCache.get(page)
+            except pywikibot.NoPage:
+                continue
+            revid = G_PageCache.revision(page)
+            if known.get(normalTitle(title)) != revid:
+                self._index(title,text,revid)
+                changed += 1
+
+        # Galleries that are gone
+        gone = set(known) - set(normalTitle(t) for t in titles)
+        for title in gone:
+            self._store.write(self._forget(title))
+        out("Gallery index: %d galleries, %d indexed, %d removed" % (len(titles),changed,len(gone)))
+
+    def _forget(self,title):
+        """The statements removing title from the index, see Store.write()"""
+        return [("DELETE FROM gallery_files WHERE page=?",[(title,)]),
+                ("DELETE FROM gallery_pages WHERE page=?",[(title,)])]
+
+    def _index(self,title,text,revid):
+        title = normalTitle(title)
+        files = GalleryPage(text).files.keys()
+        self._store.write(self._forget(title) +
+                          [("INSERT OR IGNORE INTO gallery_files VALUES (?,?)",[(f,title) for f in files]),
+                           ("INSERT INTO gallery_pages VALUES (?,?)",[(title,revid)])])
+
+    def update(self,title,text,revid):
+        """Note that we saved a new version of the page title"""
+        if normalTitle(title).startswith(GalleryPrefix) and self.built():
+            self._index(title,text,revid)
+
+    def pages(self,fileName):
+        """The titles of the galleries listing fileName, None if the index has not been built"""
+        if not self.built():
+            return None
+        return [row[0] for row in self._store.execute("SELECT page FROM gallery_files WHERE file=? ORDER BY page",
+                                                      (fileKey(fileName),))]
+
+
+class GalleryPage():
+    """
+    The featured picture lists split into sections and galleries
+
+    The text is split into lines once, recording the line of each
+    section heading, the first and last line of each <gallery> block
+    and the lines showing each file. The operations then change only
+    the lines involved, each in time linear in the size of the page.
+    """
+
+    def __init__(self,text):
+        self.lines = text.splitlines(True)
+        self._parse()
+
+    def _parse(self):
+        self.sections  = [] # (title,line)
+        self.galleries = [] # [first line,last line], the lines of the tags
+        self.files     = {} # file -> [line]
+        self.links     = [] # the lines with an image link
+        self._tags     = [] # (end of the opening tag,start of the closing tag) of each gallery
+        opened = None
+        for i,line in enumerate(self.lines):
+            # Only the first character decides if it is a heading
+            if line.lstrip()[:1] == '=':
+                m = GallerySectionR.match(line)
+                if m:
+                    self.sections.append((m.group(2),i))
+                continue
+            start = 0
+            if 'gallery' in line:
+                # The tags may share their line with a file
+                for m in GalleryTagR.finditer(line):
+                    if not m.group(1) and opened is None:
+                        opened = (i,m.end())
+                        start = m.end()
+                    elif m.group(1) and opened is not None:
+                        self.galleries.append([opened[0],i])
+                        self._tags.append((opened[1],m.start()))
+                        opened = None
+            m = GalleryFileR.match(line[start:] if start else line)
+            if m:
+                self.files.setdefault("File:" + normalTitle(m.group(1)),[]).append(i)
+            if '[[' in line and GalleryLinkR.search(line):
+                self.links.append(i)
+
+    def text(self):
+        """The text of the page with all changes"""
+        return "".join(self.lines)
+
+    def contains(self,fileName):
+        """Check if a line of the page shows fileName"""
+        return fileKey(fileName) in self.files
+
+    def count(self,n=-1):
+        """The number of lines of gallery n showing a file"""
+        first,last = self.galleries[n]
+        return len([i for lines in self.files.values() for i in lines if first <= i <= last])
+
+    def _newline(self,i):
+        """Make sure line i ends such that a line can follow it"""
+        if not self.lines[i].endswith("\n"):
+            self.lines[i] += "\n"
+
+    def _isolate(self,n):
+        """
+        Put the tags of gallery n on lines of their own, if they share them
+        with files, such that lines can be added next to them.
+        Returns the first and last line of the gallery.
+        """
+        first,last = self.galleries[n]
+        opening,closing = self._tags[n]
+        # The closing tag first, the opening one may be on the same line before it
+        line = self.lines[last]
+        if line[:closing].strip():
+            self.lines[last:last+1] = [line[:closing].rstrip() + "\n",line[closing:]]
+        line = self.lines[first]
+        if line[opening:].strip():
+            self.lines[first:first+1] = [line[:opening] + "\n",line[opening:]]
+        self._parse()
+        return self.galleries[n]
+
+    def insertFirst(self,section,line):
+        """
+        Insert line first in the gallery of section and drop the last
+        line of it, such that it keeps the same number of files.
+        Returns False if the section has no gallery.
+        """
+        nameR = G_Patterns.compile(r'^%s$' % wikipattern(section))
+        starts = [i for title,i in self.sections if nameR.match(SectionNameR.sub(r'\1',title).strip())]
+        if not starts:
+            return False
+        ends = [i for title,i in self.sections if i > starts[0]]
+        end = ends[0] if ends else len(self.lines)
+        galleries = [n for n,g in enumerate(self.galleries) if starts[0] < g[0] < end]
+        if not galleries:
+            return False
+        first,last = self._isolate(galleries[0])
+        if last - first > 1:
+            del self.lines[last-1]
+        self.lines.insert(first+1,line + "\n")
+        self._parse()
+        return True
+
+    def appendToLastGallery(self,line):
+        """Add line last in the last gallery of the page, returns False if there is none"""
+        if not self.galleries:
+            return False
+        first,last = self._isolate(len(self.galleries) - 1)
+        self._newline(last-1)
+        self.lines.insert(last,line + "\n")
+        self._parse()
+        return True
+
+    def appendAfterLastFile(self,line):
+        """Add line after the last line with an image link, returns False if there is none"""
+        if not self.links:
+            return False
+        last = self.links[-1]
+        self._newline(last)
+        self.lines.insert(last+1,line + "\n")
+        self._parse()
+        return True
+
+    def remove(self,fileName):
+        """Remove the lines showing fileName, returns the number of lines removed"""
+        lines = self.files.get(fileKey(fileName),[])
+        for i in reversed(lines):
+            del self.lines[i]
+        self._parse()
+        return len(lines)
+
+    def annotate(self,fileName,note):
+        """Add note to the end of the lines showing fileName, returns the number of lines changed"""
+        lines = self.files.get(fileKey(fileName),[])
+        for i in lines:
+            line = self.lines[i].rstrip("\r\n")
+            self.lines[i] = line + note + self.lines[i][len(line):]
+        return len(lines)
+
+
+class EditBatch():
+    """
+    Collects the changes candidates want to make to shared pages
+
+    The changes are kept per page as transformations of the text,
+    flush() applies all of them to each page and saves it with one
+    edit, such that a page is downloaded and edited once per run.
+    Text that is just appended to a page is sent without downloading
+    the page at all.
+    """
+
+    def __init__(self):
+        self._edits = collections.OrderedDict() # title -> [page,create,[(transform,comment,step)],[appends]]
+        self._lock  = threading.Lock()
+
+    def _edit(self,page):
+        return self._edits.setdefault(page.title(),[page,False,[],[]])
+
+    def add(self,page,transform,comment,create=False,step=None):
+        """Queue a change of page, see Candidate.edit()"""
+        if step:
+            G_Journal.intend(*step)
+        with self._lock:
+            edit = self._edit(page)
+            edit[1] = edit[1] or create
+            edit[2].append((transform,comment,step))
+        return self
+
+    def append(self,page,text,comment,marker,section=None,step=None):
+        """Queue text to be appended to page, see Candidate.append()"""
+        if step:
+            G_Journal.intend(*step)
+        with self._lock:
+            self._edit(page)[3].append((text,comment,marker,section,step))
+        return self
+
+    def flush(self):
+        """Apply and commit all queued changes"""
+        with self._lock:
+            edits = self._edits.values()
+            self._edits = collections.OrderedDict()
+
+        for page,create,changes,appends in edits:
+            if G_Abort:
+                # The steps left are journaled as unfinished and done next time
+                out("Aborting, not saving '%s'" % page.title(), color="lightred")
+                continue
+            for attempt in range(MaxEditConflicts + 1):
+                try:
+                    if changes:
+                        self._apply(page,create,changes)
+                    if appends:
+                        self._append(page,appends)
+                    break
+                except pywikibot.EditConflict:
+                    # Get the current text and do the same changes again
+                    out("Edit conflict on '%s', retrying..." % page.title(), color="lightyellow")
+                    G_PageCache.invalidate(page)
+                except pywikibot.NoPage:
+                    out("No such page '%s'" % page.title(), color="lightred")
+                    break
+                except pywikibot.LockedPage:
+                    out("Page is locked '%s'" % page.title(), color="lightred")
+                    break
+                except pywikibot.Error, error:
+                    # The steps left are journaled as unfinished, the other pages are still saved
+                    out("Could not save '%s': %s" % (page.title(),error), color="lightred")
+                    break
+            else:
+                out("Giving up on '%s' after %d edit conflicts" % (page.title(),attempt + 1), color="lightred")
+
+    def _apply(self,page,create,changes):
+        """Apply the changes to the current text of page and commit it"""
+        try:
+            old_text = G_PageCache.get(page)
+        except pywikibot.NoPage:
+            if not create:
+                raise
+            old_text = ""
+
+        new_text = old_text
+        comments = []
+        steps = []
+        for transform,comment,step in changes:
+            text = transform(new_text)
+            if text is None:
+                # It could not be done, the step stays unfinished and is tried on the next run
+                continue
+            if text != new_text:
+                comments.append(comment)
+            new_text = text
+            steps.append(step)
+
+        revid = G_PageCache.revision(page)
+        if comments:
+            revid = commit(old_text,new_text,page,"; ".join(comments),revid)
+            if not revid:
+                return
+        # Steps that did not change anything found it already done
+        self._done(steps,revid)
+
+    def _append(self,page,appends):
+        """Append the texts not yet on page, new sections are added one by one"""
+        present = pageContains(page.title(),[marker[:2] for text,comment,marker,section,step in appends])
+
+        texts = []
+        comments = []
+        steps = []
+        for text,comment,marker,section,step in appends:
+            if self._present(page,marker,present):
+                # Can happen if the process have been previously interrupted.
+                out("Skipping append to '%s', '%s' already there" % (page.title(),marker[1]), color="lightred")
+                self._done([step])
+            elif section:
+                self._done([step],commitAppend(page,text,comment,section))
+            else:
+                texts.append(text)
+                comments.append(comment)
+                steps.append(step)
 
-    def __init__(self, candidate, check):
-        threading.Thread.__init__(self)
-        self.candidate = candidate
-        self.check = check
+        if texts:
+            self._done(steps,commitAppend(page,"".join(texts),"; ".join(comments)))
+
+    def _present(self,page,marker,present):
+        """Check if marker tells that the text was added to page, present is what pageContains() found"""
+        if normalTitle(marker[1]) not in present:
+            return False
+        # The page may use the template for something else, so also look for the parameters
+        return len(marker) < 3 or bool(re.search(marker[2],G_PageCache.get(page)))
+
+    def _done(self,steps,revid=True):
+        """Journal the steps as done by revid, unless the edit was not saved"""
+        if not revid:
+            return
+        for step in steps:
+            if step:
+                G_Journal.done(step[0],step[1],revid if revid is not True else None)
+
+
+class RecentChanges():
+    """
+    The pages edited in the project namespace, polled through list=recentchanges
+
+    Each call to changes() returns the titles edited since the previous
+    call. The changes made at the timestamp we continue from are returned
+    by the api again, so their ids are remembered to skip them.
+    """
+
+    def __init__(self):
+        self._since = datetime.datetime.utcnow().strftime(TimestampFormat)
+        self._seen  = set()
+
+    def changes(self):
+        """The titles of the pages edited since the last call"""
+        titles = []
+        for q in G_Api.query(list='recentchanges',rcnamespace=4,rctype='edit|new',
+                             rcprop='title|ids|timestamp',rcdir='newer',
+                             rcstart=self._since,rclimit='max'):
+            for change in q.get('recentchanges',[]):
+                if change['rcid'] in self._seen:
+                    continue
+                if change['timestamp'] != self._since:
+                    self._since = change['timestamp']
+                    self._seen  = set()
+                self._seen.add(change['rcid'])
+                titles.append(change['title'])
+        return titles
+
+
+class FileFeed():
+    """
+    The pages edited as read from a file of EventStreams recentchange events
+
+    The file has one json event per line, which may be prefixed with 'data: '
+    as sent by the stream such that the output of a client reading the stream
+    can be used as it is, other lines are ignored. Only the lines appended
+    after the file was opened are read, each call to changes() returns the
+    titles from the lines appended since the previous call.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self._file = open(path)
+        self._file.seek(0,os.SEEK_END)
+        self._partial = ""
+
+    def changes(self):
+        """The titles of the pages edited since the last call"""
+        titles = []
+        for line in iter(self._file.readline,""):
+            line = self._partial + line
+            if not line.endswith("\n"):
+                # The rest of the line is not written yet
+                self._partial = line
+                break
+            self._partial = ""
+
+            line = line.strip()
+            if line.startswith("data:"):
+                line = line[len("data:"):].strip()
+            if not line.startswith("{"):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                out("Warning - bad event in '%s': %s" % (self.path,line[:80]), color="lightred")
+                continue
+            if event.get('wiki','commonswiki') != 'commonswiki' or event.get('type','edit') not in ('edit','new'):
+                continue
+            if event.get('title'):
+                titles.append(event['title'])
+        return titles
+
+
+class Daemon():
+    """
+    Keeps closing and parking the candidates for as long as we run
+
+    All open nominations are kept in memory, after checking them once we only
+    check a candidate again when its page was edited, as told by the feed,
+    or when its next deadline has passed, see Deadlines.
+    A candidate list is only read again when it was edited.
+    """
+
+    def __init__(self,feed,lists):
+        self._feed  = feed
+        self._lists = lists     # [(candidate list page,delist)]
+        self._open  = {}        # candidate list page -> {title: Candidate}
 
     def run(self):
-        self.check(self.candidate)
+        """Check all candidates, then the ones that changed every DaemonPollSeconds"""
+        todo = []
+        for page,delist in self._lists:
+            todo.extend(self._readList(page,delist))
+        self._check(todo)
+
+        while not G_Abort:
+            for i in range(DaemonPollSeconds):
+                if G_Abort:
+                    return
+                time.sleep(1)
+            try:
+                self._round()
+            except (pywikibot.Error,IOError), error:
+                out("Warning - %s, trying again later" % error, color="lightred")
+            except Exception:
+                # Keep running, what this round missed is checked once it changes again or is due
+                out("Warning - unexpected error, trying again later\n%s" % traceback.format_exc(), color="lightred")
+
+    def _expire(self):
+        """Forget which pages exist and what we know about the voters, it may have changed since"""
+        global G_Exists, G_Users
+        G_Exists = PageExistence()
+        # The users are still read from the store for UserInfoDays
+        G_Users  = UserInfo(G_Store)
+
+    def _round(self):
+        """Check the candidates that changed or are due"""
+        self._expire()
+        titles = set(normalTitle(title) for title in self._feed.changes())
+        for title in titles:
+            # Edited by someone else, or by us in an earlier round
+            G_PageCache.invalidate(pywikibot.Page(pywikibot.Site(),title))
+            G_Revisions.invalidate(title)
+
+        todo = []
+        for page,delist in self._lists:
+            if normalTitle(page) in titles:
+                out("'%s' was edited, reading it again" % page, date=True)
+                todo.extend(self._readList(page,delist))
+
+        titles.update(G_Deadlines.popDue())
+        for candidates in self._open.values():
+            for title,candidate in candidates.items():
+                if title in titles and candidate not in todo:
+                    todo.append(candidate)
+        self._check(todo)
+
+    def _readList(self,page,delist):
+        """Find the candidates on page, returns the ones we did not know"""
+        found = {}
+        for candidate in filter(containsPattern,findCandidates(page,delist)):
+            found[normalTitle(candidate.page.title())] = candidate
+        if not G_MatchPattern:
+            G_Deadlines.keepOnly(normalTitle(page),found.keys())
+
+        known = self._open.get(page,{})
+        self._open[page] = dict((title,known.get(title,candidate)) for title,candidate in found.items())
+        return [candidate for title,candidate in found.items() if title not in known]
+
+    def _check(self,candidates):
+        """Close or park each of candidates"""
+        if not candidates:
+            return
+        out("Checking %d candidates..." % len(candidates), date=True)
+        for check in (Candidate.closePage,Candidate.park):
+            for candidate in candidates:
+                candidate.reset()
+            if check == Candidate.closePage:
+                runChecks(check,candidates,voters=True,deadlines=True)
+            else:
+                runChecks(check,candidates)
+            G_EditBatch.flush()
+            if G_Abort:
+                return
+
+
+class DumpFile():
+    """
+    A bz2 compressed xml dump, read as one file
+
+    The dumps are made of one or more bz2 streams, the multistream
+    dumps have one for every hundred pages, all of them are read.
+    """
+
+    def __init__(self,path):
+        self._file = open(path,'rb')
+        self._bz2  = bz2.BZ2Decompressor()
+        self._data = ""         # Uncompressed data, read up to _pos
+        self._pos  = 0
+
+    def read(self,size=-1):
+        """Returns up to size bytes of the uncompressed dump, all of it if size is negative"""
+        while size < 0 or len(self._data) - self._pos < size:
+            data = self._file.read(DumpChunkSize)
+            if not data:
+                break
+            self._data = self._data[self._pos:]
+            self._pos  = 0
+            while data:
+                try:
+                    self._data += self._bz2.decompress(data)
+                except EOFError:
+                    # The stream ended exactly at the end of the last chunk
+                    self._bz2 = bz2.BZ2Decompressor()
+                    continue
+                data = self._bz2.unused_data
+                if data:
+                    self._bz2 = bz2.BZ2Decompressor()
+        if size < 0:
+            size = len(self._data) - self._pos
+        data = self._data[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class VoteMatcher():
+    """
+    Finds the vote templates in the text of a candidate
+
+    The patterns of the template lists are expanded into a table
+    of all the names they match, such that a template is classified
+    by one lookup of its name. Each template start is looked at once,
+    which keeps the scan linear in the size of the text even for the
+    pages where the vote regexps have to backtrack.
+    """
+
+    def __init__(self,*kinds):
+        """kinds are the template lists, f.ex. support, oppose and neutral"""
+        self._kinds = len(kinds)
+        self._names = {}
+        for kind,patterns in enumerate(kinds):
+            for pattern in patterns:
+                for name in expandTemplateName(pattern):
+                    self._names.setdefault(name,kind)
+
+    def kind(self,name):
+        """The index of the list the template name is in, None if it is no vote"""
+        return self._names.get(name)
+
+    def scan(self,text):
+        """
+        Returns a list for each kind of vote with the (start,end)
+        positions of the templates found. Like the vote regexps
+        a template with parameters counts if the line it is on
+        has a '}}' after the parameters, or the next non blank
+        line starts with one.
+        """
+        found = [[] for i in range(self._kinds)]
+        lineEnd = -1
+        lastClose = -1
+        closedBelow = False
+
+        for m in VoteTemplateR.finditer(text):
+            kind = self._names.get(m.group(1))
+            if kind is None:
+                continue
+            if m.group(2):
+                # The end of the parameters is the last '}}' of the line,
+                # each line is only searched once
+                pos = m.end()
+                if pos > lineEnd:
+                    lineEnd = text.find('\n',pos)
+                    if lineEnd == -1:
+                        lineEnd = len(text)
+                    lastClose = text.rfind('}}',pos,lineEnd)
+                    closedBelow = CloseBelowR.match(text,lineEnd) is not None
+                if lastClose < pos and not closedBelow:
+                    continue
+            found[kind].append((m.start(),m.end()))
+        return found
 
 
 class Candidate():
@@ -52,7 +1698,7 @@ class Candidate():
     This class just serves as base for the DelistCandidate and FPCandidate classes
     """
 
-    def __init__(self, page, ProR, ConR, NeuR, ProString, ConString, ReviewedR, CountedR, VerifiedR ):
+    def __init__(self, page, ProR, ConR, NeuR, Votes, ProString, ConString, ReviewedR, CountedR, VerifiedR ):
         """page is a pywikibot.Page object"""
 
         # Later perhaps this can be cleaned up by letting the subclasses keep the variables
@@ -63,12 +1709,14 @@ class Candidate():
         self._proR         = ProR  # Regexp for positive votes
         self._conR         = ConR  # Regexp for negative votes
         self._neuR         = NeuR  # Regexp for neutral  votes
+        self._votes        = Votes # VoteMatcher finding all three kinds of votes
         self._proString    = ProString
         self._conString    = ConString
         self._ReviewedR    = ReviewedR
         self._CountedR     = CountedR
         self._VerifiedR    = VerifiedR
         self._votesCounted = False
+        self._scan         = None
         self._daysOld      = -1
         self._daysSinceLastEdit = -1
         self._creationTime = None
@@ -89,32 +1737,56 @@ class Candidate():
                                self.daysOld(),self.daysSinceLastEdit(),self.sectionCount(),
                                self.imageCount(),self.isWithdrawn(),
                                self.statusString()))
+            self.reportVoters()
         except pywikibot.NoPage:
             out("%s: -- No such page -- " % self.cutTitle(), color="lightred")
 
 
     def nominator(self,link=True):
         """Return the link to the user that nominated this candidate"""
-        history = self.page.getVersionHistory(reverseOrder=True,total=1)
-        if not history:
+        first = G_Revisions.first(self.page.title())
+        if not first:
             return "Unknown"
         if link:
-            return "[[User:%s|%s]]" % (history[0][2],history[0][2])
+            return "[[User:%s|%s]]" % (first[1],first[1])
         else:
-            return history[0][2]
+            return first[1]
 
     def uploader(self):
         """Return the link to the user that uploaded the nominated image"""
-        page = pywikibot.Page(pywikibot.Site(), self.fileName())
-        history = page.getVersionHistory(reverseOrder=True,total=1)
-        if not history:
+        first = G_Revisions.first(self.fileName())
+        if not first:
             return "Unknown"
-        return "[[User:%s|%s]]" % (history[0][2],history[0][2])
+        return "[[User:%s|%s]]" % (first[1],first[1])
 
     def creator(self):
         """Return the link to the user that created the image"""
         return self.uploader()
 
+    def scan(self):
+        """
+        Returns the CandidateScan of this nomination,
+        the page is only scanned the first time this is called
+        """
+        if self._scan is None:
+            title = self.page.title()
+            revid = G_PageCache.revision(self.page)
+            self._scan = G_PageStore.scan(title,revid)
+            if self._scan is None:
+                # Lines were just added, f.ex. a vote
+                previous = G_PageStore.previous(title,revid)
+                if previous:
+                    self._scan = appendScan(previous[0],previous[1],previous[2],
+                                            self._votes,
+                                            self._ReviewedR,self._CountedR,self._VerifiedR)
+                if self._scan is None:
+                    self._scan = scanCandidate(G_PageCache.get(self.page),
+                                               G_PageCache.filtered(self.page),
+                                               self._votes,
+                                               self._ReviewedR,self._CountedR,self._VerifiedR)
+                G_PageStore.saveScan(title,revid,self._scan)
+        return self._scan
+
     def countVotes(self):
         """
         Counts all the votes for this nomination
@@ -124,28 +1796,74 @@ class Candidate():
         if self._votesCounted:
             return
 
-        text = self.page.get(get_redirect=True)
-        if text:
-            text = filter_content(text)
-
-            self._pro = len(re.findall(self._proR,text))
-            self._con = len(re.findall(self._conR,text))
-            self._neu = len(re.findall(self._neuR,text))
-        else:
+        scan = self.scan()
+        if scan.empty:
             out("Warning - %s has no content" % self.page, color="lightred")
+        else:
+            self._pro = scan.pro
+            self._con = scan.con
+            self._neu = scan.neu
 
         self._votesCounted = True
 
+    def voters(self):
+        """
+        The user that signed each vote as (kind,user) tuples, kind is 0, 1
+        or 2 for positive, negative and neutral votes and user is None for
+        unsigned votes, see attributeVotes()
+        """
+        return self.scan().voters
+
+    def unsignedLines(self):
+        """
+        The lines of the page with votes that are not signed, counting
+        from 1. The votes are found in the filtered text again, and their
+        positions mapped back to the page with originalPositions().
+        """
+        text = G_PageCache.get(self.page)
+        filtered = G_PageCache.filtered(self.page)
+        found = self._votes.scan(filtered)
+        starts = sorted(start for votes in found for start,end in votes)
+        unsigned = [start for start,(kind,user) in zip(starts,attributeVotes(filtered,found)) if user is None]
+        return [text.count('\n',0,pos) + 1 for pos in originalPositions(filter_spans(text),unsigned)]
+
+    def reportVoters(self):
+        """
+        Console output of the votes that are not signed and of the users
+        that voted more than once. This does not change the vote count.
+        """
+        unsigned = len([user for kind,user in self.voters() if user is None])
+        votes = collections.Counter(user for kind,user in self.voters() if user)
+        twice = ["%s (%d)" % (user,n) for user,n in sorted(votes.items()) if n > 1]
+        if self.imageCount() > 1:
+            # With alternatives each user can vote once for each of them
+            twice = []
+
+        # Only the users looked up by preloadVoters() are checked
+        ineligible = []
+        for user in sorted(votes):
+            if G_Users.known(user):
+                why = G_Users.ineligible(user,self.creationTime())
+                if why:
+                    ineligible.append("%s (%s)" % (user,why))
+
+        if unsigned:
+            plural = "s" if unsigned > 1 else ""
+            out("%s: %d unsigned vote%s on line%s %s" % (self.cutTitle(),unsigned,plural,plural,
+                                                        ", ".join(str(line) for line in self.unsignedLines())),
+                color="lightyellow")
+        if twice:
+            out("%s: Voted more than once: %s" % (self.cutTitle(),", ".join(twice)), color="lightyellow")
+        if ineligible:
+            out("%s: Votes from users that may not vote: %s" % (self.cutTitle(),", ".join(ineligible)), color="lightyellow")
+
     def isWithdrawn(self):
         """Withdrawn nominations should not be counted"""
-        text = self.page.get(get_redirect=True)
-        text = filter_content(text)
-        withdrawn  = len(re.findall(WithdrawnR,text))
-        return withdrawn>0
+        return self.scan().withdrawn
 
     def isFPX(self):
         """Page marked with FPX template"""
-        return len(re.findall(FpxR,self.page.get(get_redirect=True)))
+        return self.scan().fpx
 
     def rulesOfFifthDay(self):
         """Check if any of the rules of the fifth day can be applied"""
@@ -170,7 +1888,7 @@ class Candidate():
         """
 
         # First make a check that the page actually exist:
-        if not self.page.exists():
+        if not G_PageCache.exists(self.page):
             out("\"%s\" no such page?!" % self.cutTitle() )
             return
 
@@ -196,35 +1914,42 @@ class Candidate():
             out("\"%s\" is still active, ignoring" % self.cutTitle())
             return False
 
-        old_text = self.page.get(get_redirect=True)
+        old_text = G_PageCache.get(self.page)
         if not old_text:
             out("Warning - %s has no content" % self.page, color="lightred")
             return False
 
-        if re.search(r'{{\s*FPC-closed-ignored.*}}',old_text):
+        if self.scan().ignored:
             out("\"%s\" is marked as ignored, so ignoring" % self.cutTitle())
             return False
 
-        if re.search(self._CountedR,old_text):
+        if self.scan().counted:
             out("\"%s\" needs review, ignoring" % self.cutTitle())
             return False
 
-        if re.search(self._ReviewedR,old_text):
+        if self.scan().reviewed:
             out("\"%s\" already closed and reviewed, ignoring" % self.cutTitle())
             return False
 
         if self.imageCount() <= 1:
             self.countVotes()
+            self.reportVoters()
 
         result = self.getResultString()
 
-        new_text = old_text + result
+        def close(text):
+            # Someone else may have closed it while we were working
+            if re.search(self._CountedR,text) or re.search(self._ReviewedR,text):
+                return text
 
-        # Add the featured status to the header
-        if self.imageCount() <= 1:
-            new_text = self.fixHeader(new_text)
+            new_text = text + result
 
-        self.commit(old_text,new_text,self.page,self.getCloseCommitComment() + (" (FifthDay=%s)" % ("yes" if fifthDay else "no")) )
+            # Add the featured status to the header
+            if self.imageCount() <= 1:
+                new_text = self.fixHeader(new_text)
+            return new_text
+
+        self.edit(self.page,close,self.getCloseCommitComment() + (" (FifthDay=%s)" % ("yes" if fifthDay else "no")),batch=False)
 
         return True
 
@@ -236,7 +1961,7 @@ class Candidate():
         """
 
         # Check if they are alredy there
-        if re.match(r'===.*(%s|%s)===' % (self._proString,self._conString),text):
+        if G_Patterns.compile(r'===.*(%s|%s)===' % (self._proString,self._conString)).match(text):
             return text
 
         status = ""
@@ -250,7 +1975,7 @@ class Candidate():
         if len(status) < 1:
             status = ", %s" % self._proString if self.isPassed() else ", %s" % self._conString
 
-        return re.sub(r'(===.*)(===)',r"\1%s\2" % status, text, 1)
+        return HeaderR.sub(r"\1%s\2" % status, text, 1)
 
     def getResultString(self):
         """Must be implemented by the subclasses (Text to add to closed pages)"""
@@ -270,12 +1995,12 @@ class Candidate():
         if self._creationTime:
             return self._creationTime
 
-        history = self.page.getVersionHistory(reverseOrder=True,total=1)
-        if not history:
+        first = G_Revisions.first(self.page.title())
+        if not first:
             out("Could not retrieve history for '%s', returning now()" % self.page.title())
             return datetime.datetime.now()
 
-        self._creationTime = history[0][1]
+        self._creationTime = first[0]
 
         #print "C:" + self._creationTime.isoformat()
         #print "N:" + datetime.datetime.utcnow().isoformat()
@@ -311,12 +2036,11 @@ class Candidate():
         if self._daysSinceLastEdit != -1:
             return self._daysSinceLastEdit
 
-        try:
-            lastEdit = datetime.datetime.strptime(str(self.page.editTime()),"%Y%m%d%H%M%S")
-        except:
+        latest = G_Revisions.latest(self.page.title())
+        if not latest:
             return -1
 
-        delta = datetime.datetime.utcnow() - lastEdit
+        delta = datetime.datetime.utcnow() - latest[0]
         self._daysSinceLastEdit = delta.days
         return self._daysSinceLastEdit
 
@@ -326,6 +2050,39 @@ class Candidate():
         """
         return self.daysOld() >= 9
 
+    def nextCheck(self):
+        """
+        The next time one of the rules for closing this nomination
+        can become valid without the page being edited, that is when
+        it is five and nine days old, or a day after the last edit if
+        it was withdrawn or FPXed. Returns a (time,rule) tuple, or None
+        if all of those times have passed.
+        """
+        created = self.creationTime()
+        times = [(created + datetime.timedelta(days=5),"fifth day"),
+                 (created + datetime.timedelta(days=9),"nine days old")]
+        if self.isWithdrawn() or self.isFPX():
+            latest = G_Revisions.latest(self.page.title())
+            if latest:
+                times.append((latest[0] + datetime.timedelta(days=1),"a day since the last edit"))
+
+        now = datetime.datetime.utcnow()
+        times = [t for t in times if t[0] > now]
+        return min(times) if times else None
+
+    def reset(self):
+        """
+        Forget what was found out about the current revision
+        of the page and its age, such that it is checked again
+        """
+        self._votesCounted = False
+        self._scan         = None
+        self._daysOld      = -1
+        self._daysSinceLastEdit = -1
+        self._imgCount     = None
+        self._fileName     = None
+        self._alternative  = None
+
     def isPassed(self):
         """
         Find if an image can be featured.
@@ -349,8 +2106,7 @@ class Candidate():
 
     def sectionCount(self):
         """Count the number of sections in this candidate"""
-        text = self.page.get(get_redirect=True)
-        return len(re.findall(SectionR,text))
+        return self.scan().sections
 
     def imageCount(self):
         """
@@ -363,24 +2119,14 @@ class Candidate():
         if self._imgCount:
             return self._imgCount
 
-        text = self.page.get(get_redirect=True)
-
-        matches = []
-        for m in re.finditer(ImagesR,text):
-            matches.append(m)
-
-        count = len(matches)
+        images = self.scan().images
+        count = len(images)
 
         if count >= 2:
             # We have several images, check if they are too small to be counted
-            for img in matches:
-
-                if re.search(ImagesThumbR,img.group(0)):
+            for name,size,thumb in images:
+                if thumb or (size is not None and size <= 150):
                     count -= 1
-                else:
-                    s = re.search(ImagesSizeR,img.group(0))
-                    if s and (int(s.group(1)) <= 150):
-                        count -= 1
 
         self._imgCount = count
         return count
@@ -395,8 +2141,35 @@ class Candidate():
         contains four values:
         support,oppose,neutral,(featured|not featured)
         """
-        text = self.page.get(get_redirect=True)
-        return re.findall(PreviousResultR,text)
+        return list(self.scan().existing)
+
+    def compareVoteMatcher(self):
+        """
+        Counts the votes both with the VoteMatcher and with the
+        old vote regexps and lists the candidates where they differ.
+        This is for testing the VoteMatcher.
+        """
+        text = G_PageCache.filtered(self.page)
+        old = [len(m) for m in scanTokens(text,TemplateTokenR,(self._proR,self._conR,self._neuR))]
+        new = [len(v) for v in self._votes.scan(text)]
+
+        out("%s: S:%02d/%02d O:%02d/%02d N:%02d/%02d (%s)" % (self.cutTitle(),
+                                                            new[0],old[0],new[1],old[1],new[2],old[2],
+                                                            "OK" if new == old else "DIFF"),
+            color=None if new == old else "lightred")
+
+    def compareAppendScan(self):
+        """
+        Splits the page at up to AppendTestSplits lines, and compares
+        the scan made by appendScan() from the scan of the part above
+        with the scan of the whole page. This is for testing the
+        incremental scans of pages that votes were added to.
+        """
+        appended,rescanned,differ = compareScans(G_PageCache.get(self.page),AppendTestSplits,self._votes,
+                                                 self._ReviewedR,self._CountedR,self._VerifiedR)
+        out("%s: %d appended, %d scanned again (%s)" % (self.cutTitle(),appended,rescanned,
+                                                        "DIFF %d" % differ if differ else "OK"),
+            color="lightred" if differ else None)
 
     def compareResultToCount(self):
         """
@@ -404,24 +2177,27 @@ class Candidate():
         it to a new vote count made by this bot and
         see if they match. This is for testing purposes
         of the bot and to find any incorrect old results.
+
+        Returns a (status,difference) tuple, status is OK, FAIL or
+        why it was ignored, difference names the counts that differ.
         """
         res = self.existingResult()
 
         if self.isWithdrawn():
             out("%s: (ignoring, was withdrawn)" % self.cutTitle())
-            return
+            return "withdrawn",""
 
         elif self.isFPX():
             out("%s: (ignoring, was FPXed)" % self.cutTitle())
-            return
+            return "FPXed",""
 
         elif not res:
             out("%s: (ignoring, has no results)" % self.cutTitle())
-            return
+            return "no results",""
 
         elif len(res) > 1:
             out("%s: (ignoring, has several results)" % self.cutTitle())
-            return
+            return "several results",""
 
         # We have one result, so make a vote count and compare
         old_res = res[0]
@@ -436,6 +2212,14 @@ class Candidate():
         else:
             status = "FAIL"
 
+        # What differs and whether we counted more (+) or less (-)
+        difference = []
+        for name,counted,was in (("support",self._pro,ws),("oppose",self._con,wo),("neutral",self._neu,wn)):
+            if counted != was:
+                difference.append(name + ("+" if counted > was else "-"))
+        if was_featured != self.isPassed():
+            difference.append("featured")
+
         # List info to console
         out("%s: S%02d/%02d O:%02d/%02d N%02d/%02d F%d/%d (%s)" % (self.cutTitle(),
                                                                    self._pro,ws,
@@ -443,6 +2227,13 @@ class Candidate():
                                                                    self._neu,wn,
                                                                    self.isPassed(),was_featured,
                                                                    status))
+        self.reportVoters()
+        return status," ".join(difference)
+
+    def scanText(self,text):
+        """Use the scan of text instead of that of the page, f.ex. for a text from a dump"""
+        self._scan = scanCandidate(text,filter_content(text),self._votes,
+                                   self._ReviewedR,self._CountedR,self._VerifiedR)
 
     def cutTitle(self):
         """Returns a fixed width title"""
@@ -476,11 +2267,11 @@ class Candidate():
         if self._fileName:
             return self._fileName
 
-        self._fileName = re.sub("(%s.*?)([Ff]ile|[Ii]mage)" % candPrefix,r'\2',self.page.title())
+        self._fileName = fileNameFromTitle(self.page.title())
 
-        if not pywikibot.Page(pywikibot.Site(), self._fileName).exists():
-            match = re.search(ImagesR,self.page.get(get_redirect=True))
-            if match: self._fileName = match.group(1)
+        if not G_Exists.exists(self._fileName):
+            images = self.scan().images
+            if images: self._fileName = images[0][0]
 
         return self._fileName
 
@@ -495,30 +2286,33 @@ class Candidate():
 
         @param category The categorization category
         """
-
+        if self.stepDone("addToFeaturedList"):
+            return
 
         listpage = 'Commons:Featured pictures, list'
         page = pywikibot.Page(pywikibot.Site(), listpage)
-        old_text = page.get(get_redirect=True)
-
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-        if re.search(wikipattern(self.fileName()),old_text):
-            out("Skipping addToFeaturedList for '%s', page already listed." % self.cleanTitle(), color="lightred")
-            return
+        fileName = self.fileName()
+        cleanTitle = self.cleanTitle()
 
         # This function first needs to find the main category
         # then inside the gallery tags remove the last line and
         # add this candidate to the top
-
-        # Thanks KODOS for a nice regexp gui
-        # This adds ourself first in the list of length 4 and removes the last
-        # all in the chosen category
-        out("Looking for category: '%s'" % wikipattern(category))
-        ListPageR = re.compile(r"(^==\s*{{{\s*\d+\s*\|%s\s*}}}\s*==\s*<gallery.*>\s*)(.*\s*)(.*\s*.*\s*)(.*\s*)(</gallery>)" % wikipattern(category), re.MULTILINE)
-        new_text = re.sub(ListPageR,r"\1%s\n\2\3\5" % self.fileName(), old_text)
-        self.commit(old_text,new_text,page,"Added [[%s]]" % self.fileName() )
+        out("Looking for category: '%s'" % category)
+
+        def add(old_text):
+            gallery = GalleryPage(old_text)
+            # First check if we are already on the page,
+            # in that case skip. Can happen if the process
+            # have been previously interrupted.
+            if gallery.contains(fileName):
+                out("Skipping addToFeaturedList for '%s', page already listed." % cleanTitle, color="lightred")
+                return old_text
+            if not gallery.insertFirst(category,fileName):
+                out("addToFeaturedList: No gallery for category '%s'" % category, color="lightred")
+                return None
+            return gallery.text()
+
+        self.edit(page,add,"Added [[%s]]" % fileName,step="addToFeaturedList")
 
     def addToCategorizedFeaturedList(self,category):
         """
@@ -529,27 +2323,35 @@ class Candidate():
 
         @param category The categorization category
         """
-        catpage = "Commons:Featured pictures/" + category
-        page = pywikibot.Page(pywikibot.Site(), catpage)
-        old_text = page.get(get_redirect=True)
-
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-        if re.search(wikipattern(self.fileName()),old_text):
-            out("Skipping addToCategorizedFeaturedList for '%s', page already listed." % self.cleanTitle(), color="lightred")
+        if self.stepDone("addToCategorizedFeaturedList"):
             return
 
-        # A few categories are treated specially, the rest is appended to the last gallery
-        if category == "Places/Panoramas":
-            new_text = re.sub(LastImageR,r'\1\n[[%s|thumb|627px|left|%s]]' % (self.fileName(),self.cleanTitle()) , old_text, 1)
-        else:
-            # We just need to append to the bottom of the gallery with an added title
-            # The regexp uses negative lookahead such that we place the candidate in the
-            # last gallery on the page.
-            new_text = re.sub('(?s)</gallery>(?!.*</gallery>)',"%s|%s\n</gallery>" % (self.fileName(),self.cleanTitle()) , old_text, 1)
+        catpage = "Commons:Featured pictures/" + category
+        page = pywikibot.Page(pywikibot.Site(), catpage)
+        fileName = self.fileName()
+        cleanTitle = self.cleanTitle()
+
+        def add(old_text):
+            gallery = GalleryPage(old_text)
+            # First check if we are already on the page,
+            # in that case skip. Can happen if the process
+            # have been previously interrupted.
+            if gallery.contains(fileName):
+                out("Skipping addToCategorizedFeaturedList for '%s', page already listed." % cleanTitle, color="lightred")
+                return old_text
+
+            # A few categories are treated specially, the rest is appended to the last gallery
+            if category == "Places/Panoramas":
+                added = gallery.appendAfterLastFile("[[%s|thumb|627px|left|%s]]" % (fileName,cleanTitle))
+            else:
+                # We just need to append to the bottom of the gallery with an added title
+                added = gallery.appendToLastGallery("%s|%s" % (fileName,cleanTitle))
+            if not added:
+                out("addToCategorizedFeaturedList: Nowhere to add the file on '%s'" % catpage, color="lightred")
+                return None
+            return gallery.text()
 
-        self.commit(old_text,new_text,page,"Added [[%s]]" % self.fileName());
+        self.edit(page,add,"Added [[%s]]" % fileName,step="addToCategorizedFeaturedList")
 
     def getImagePage(self):
         """Get the image page itself"""
@@ -563,8 +2365,10 @@ class Candidate():
         This is ==STEP 3== of the parking procedure
 
         """
+        if self.stepDone("addAssessments"):
+            return
+
         page = self.getImagePage()
-        old_text = page.get(get_redirect=True)
 
         AssR = re.compile(r'{{\s*[Aa]ssessments\s*\|(.*)}}')
 
@@ -574,30 +2378,31 @@ class Candidate():
         # differs from the alternative filename.
         comnom = "|com-nom=%s" % fn_or if fn_or != fn_al else ""
 
-        # First check if there already is an assessments template on the page
-        params = re.search(AssR,old_text)
-        if params:
-            # Make sure to remove any existing com/features or subpage params
-            # TODO: 'com' will be obsolete in the future and can then be removed
-            # TODO: 'subpage' is the old name of com-nom. Can be removed later.
-            params = re.sub(r"\|\s*(?:featured|com)\s*=\s*\d+",'',params.group(1))
-            params = re.sub(r"\|\s*(?:subpage|com-nom)\s*=\s*[^{}|]+",'',params)
-            params += "|featured=1"
-            params += comnom
-            if params.find("|") != 0:
-                params = "|" + params
-            new_ass = "{{Assessments%s}}" % params
-            new_text = re.sub(AssR,new_ass,old_text)
-            if new_text == old_text:
-                out("No change in addAssessments, '%s' already featured." % self.cleanTitle())
-                return
-        else:
-            # There is no assessments template so just add it
-            end = findEndOfTemplate(old_text,"[Ii]nformation")
-            new_text = old_text[:end] + "\n{{Assessments|featured=1%s}}\n" % comnom + old_text[end:]
-            #new_text = re.sub(r'({{\s*[Ii]nformation)',r'{{Assessments|featured=1}}\n\1',old_text)
+        def add(old_text):
+            # First check if there already is an assessments template on the page
+            params = re.search(AssR,old_text)
+            if params:
+                # Make sure to remove any existing com/features or subpage params
+                # TODO: 'com' will be obsolete in the future and can then be removed
+                # TODO: 'subpage' is the old name of com-nom. Can be removed later.
+                params = re.sub(r"\|\s*(?:featured|com)\s*=\s*\d+",'',params.group(1))
+                params = re.sub(r"\|\s*(?:subpage|com-nom)\s*=\s*[^{}|]+",'',params)
+                params += "|featured=1"
+                params += comnom
+                if params.find("|") != 0:
+                    params = "|" + params
+                new_ass = "{{Assessments%s}}" % params
+                new_text = re.sub(AssR,new_ass,old_text)
+                if new_text == old_text:
+                    out("No change in addAssessments, '%s' already featured." % self.cleanTitle())
+                return new_text
+            else:
+                # There is no assessments template so just add it
+                end = findEndOfTemplate(old_text,"[Ii]nformation")
+                return old_text[:end] + "\n{{Assessments|featured=1%s}}\n" % comnom + old_text[end:]
+                #new_text = re.sub(r'({{\s*[Ii]nformation)',r'{{Assessments|featured=1}}\n\1',old_text)
 
-        self.commit(old_text,new_text,page,"FPC promotion")
+        self.edit(page,add,"FPC promotion",batch=False,step="addAssessments")
 
     def addToCurrentMonth(self):
         """
@@ -605,27 +2410,39 @@ class Candidate():
 
         This is ==STEP 4== of the parking procedure
         """
-        monthpage = 'Commons:Featured_pictures/chronological/current_month'
-        page = pywikibot.Page(pywikibot.Site(), monthpage)
-        old_text = page.get(get_redirect=True)
-
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-        if re.search(wikipattern(self.fileName()),old_text):
-            out("Skipping addToCurrentMonth for '%s', page already listed." % self.cleanTitle(), color="lightred")
+        if self.stepDone("addToCurrentMonth"):
             return
 
-        #Find the number of lines in the gallery
-        m = re.search(r"(?ms)<gallery>(.*)</gallery>",old_text)
-        count = m.group(0).count("\n")
-
-        # We just need to append to the bottom of the gallery
-        # with an added title
-        # TODO: We lack a good way to find the creator, so it is left out at the moment
-        new_text = re.sub('</gallery>',"%s|%d '''%s''' <br> uploaded by %s, nominated by %s\n</gallery>" % 
-                          (self.fileName(), count, self.cleanTitle(), self.uploader(), self.nominator()) , old_text)
-        self.commit(old_text,new_text,page,"Added [[%s]]" % self.fileName() );
+        monthpage = 'Commons:Featured_pictures/chronological/current_month'
+        page = pywikibot.Page(pywikibot.Site(), monthpage)
+        fileName = self.fileName()
+        cleanTitle = self.cleanTitle()
+        uploader = self.uploader()
+        nominator = self.nominator()
+
+        def add(old_text):
+            gallery = GalleryPage(old_text)
+            # First check if we are already on the page,
+            # in that case skip. Can happen if the process
+            # have been previously interrupted.
+            if gallery.contains(fileName):
+                out("Skipping addToCurrentMonth for '%s', page already listed." % cleanTitle, color="lightred")
+                return old_text
+            if not gallery.galleries:
+                out("addToCurrentMonth: No gallery on '%s'" % monthpage, color="lightred")
+                return None
+
+            # The number of the new file in the gallery
+            count = gallery.count() + 1
+
+            # We just need to append to the bottom of the gallery
+            # with an added title
+            # TODO: We lack a good way to find the creator, so it is left out at the moment
+            gallery.appendToLastGallery("%s|%d '''%s''' <br> uploaded by %s, nominated by %s" %
+                                        (fileName, count, cleanTitle, uploader, nominator))
+            return gallery.text()
+
+        self.edit(page,add,"Added [[%s]]" % fileName,step="addToCurrentMonth")
 
     def notifyNominator(self):
         """
@@ -633,35 +2450,29 @@ class Candidate():
 
         This is ==STEP 5== of the parking procedure
         """
+        if self.stepDone("notifyNominator"):
+            return
+
         talk_link = "User_talk:%s" % self.nominator(link=False)
         talk_page = pywikibot.Page(pywikibot.Site(), talk_link)
 
-        try:
-            old_text = talk_page.get(get_redirect=True)
-        except pywikibot.NoPage:
+        if not G_Exists.exists(talk_page.title()):
             out("notifyNominator: No such page '%s' but ignoring..." % talk_link, color="lightred")
             return
 
         fn_or = self.fileName(alternative=False) # Original filename
         fn_al = self.fileName(alternative=True)  # Alternative filename
 
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-        if re.search("{{FPpromotion\|%s}}" % wikipattern(fn_or),old_text):
-            out("Skipping notifyNominator for '%s', page already listed at '%s'." % (self.cleanTitle(),talk_link), color="lightred")
-            return
-
         # We add the subpage parameter if the original filename
         # differs from the alternative filename.
         subpage = "|subpage=%s" % fn_or if fn_or != fn_al else ""
 
-        new_text = old_text + "\n\n== FP Promotion ==\n{{FPpromotion|%s%s}} /~~~~" % (fn_al,subpage)
-
-        try:
-            self.commit(old_text,new_text,talk_page,"FPC promotion of [[%s]]" % fn_al )
-        except pywikibot.LockedPage, error:
-            out("Page is locked '%s', but ignoring since it's just the user notification." % error, color="lightyellow")
+        # If the talk page uses the FPpromotion template with this file
+        # we have been here before, only then the page is downloaded.
+        promotedR = r"{{\s*[Ff]Ppromotion\s*\|\s*%s\s*(?:\|\s*subpage\s*=\s*%s\s*)?}}" % (wikipattern(fn_al),wikipattern(fn_or))
+        self.append(talk_page,"{{FPpromotion|%s%s}} /~~~~" % (fn_al,subpage),
+                    "FPC promotion of [[%s]]" % fn_al,('templates',"Template:FPpromotion",promotedR),
+                    section="FP Promotion",batch=False,step="notifyNominator")
 
     def moveToLog(self,reason=None):
         """
@@ -679,28 +2490,25 @@ class Candidate():
         current_month = Month[today.month]
         log_link = "Commons:Featured picture candidates/Log/%s %s" % (current_month,today.year)
         log_page = pywikibot.Page(pywikibot.Site(), log_link)
+        fileName = self.fileName()
+        cleanTitle = self.cleanTitle()
+        title = self.page.title()
 
-        # If the page does not exist we just create it ( put does that automatically )
-        try:
-            old_log_text = log_page.get(get_redirect=True)
-        except pywikibot.NoPage:
-            old_log_text = ""
-
-        if re.search(wikipattern(self.fileName()),old_log_text):
-            out("Skipping add in moveToLog for '%s', page already there" % self.cleanTitle(), color="lightred")
-        else:
-            new_log_text = old_log_text + "\n{{%s}}" % self.page.title()
-            self.commit(old_log_text,new_log_text,log_page,"Adding [[%s]]%s" % (self.fileName(),why) )
+        # If the page does not exist we just create it ( appending does that automatically ),
+        # the candidate is already in the log if the log transcludes it.
+        if not self.stepDone("addToLog"):
+            self.append(log_page,"\n{{%s}}" % title,"Adding [[%s]]%s" % (fileName,why),('templates',title),step="addToLog")
 
         # Remove from current list
-        candidate_page = pywikibot.Page(pywikibot.Site(), self._listPageName)
-        old_cand_text = candidate_page.get(get_redirect=True)
-        new_cand_text = re.sub(r"{{\s*%s\s*}}.*?\n?" % wikipattern(self.page.title()),'', old_cand_text)
+        def removeFromList(old_cand_text):
+            new_cand_text = G_Patterns.compile(r"{{\s*%s\s*}}.*?\n?" % wikipattern(title)).sub('', old_cand_text)
+            if old_cand_text == new_cand_text:
+                out("Skipping remove in moveToLog for '%s', no change." % cleanTitle, color="lightred")
+            return new_cand_text
 
-        if old_cand_text == new_cand_text:
-            out("Skipping remove in moveToLog for '%s', no change." % self.cleanTitle(), color="lightred")
-        else:
-            self.commit(old_cand_text,new_cand_text,candidate_page,"Removing [[%s]]%s" % (self.fileName(),why) )
+        candidate_page = pywikibot.Page(pywikibot.Site(), self._listPageName)
+        if not self.stepDone("removeFromList"):
+            self.edit(candidate_page,removeFromList,"Removing [[%s]]%s" % (fileName,why),step="removeFromList")
 
     def park(self):
         """
@@ -719,13 +2527,12 @@ class Candidate():
         """
 
         # First make a check that the page actually exist:
-        if not self.page.exists():
+        if not G_PageCache.exists(self.page):
             out("%s: (no such page?!)" % self.cutTitle())
             return
 
         # First look for verified results
-        text = self.page.get(get_redirect=True)
-        results = re.findall(self._VerifiedR,text)
+        results = self.scan().verified
 
         if not results:
             out("%s: (ignoring, no verified results)" % self.cutTitle())
@@ -744,7 +2551,7 @@ class Candidate():
             return
 
         # Check if the image page exist, if not we ignore this candidate
-        if not pywikibot.Page(pywikibot.Site(), self.fileName()).exists():
+        if not G_Exists.exists(self.fileName()):
             out("%s: (WARNING: ignoring, can't find image page)" % self.cutTitle())
             return
 
@@ -752,9 +2559,7 @@ class Candidate():
         vres = results[0]
 
         # If the suffix to the title has not been added, add it now
-        new_text = self.fixHeader(text,vres[3]);
-        if new_text != text:
-            self.commit(text,new_text,self.page,"Fixed header" )
+        self.edit(self.page,lambda text: self.fixHeader(text,vres[3]),"Fixed header",batch=False)
 
         if vres[3] == "yes":
             self.handlePassedCandidate(vres)
@@ -770,56 +2575,92 @@ class Candidate():
         """Must be implemented by subclass (do the park procedure for passing candidate)"""
         raise NotImplementedException()
 
-    def commit(self,old_text,new_text,page,comment):
+    def neededTitles(self):
         """
-        This will commit new_text to the page
-        and unless running in automatic mode it
-        will show you the diff and ask you to accept it.
-
-        @param old_text Used to show the diff
-        @param new_text Text to be submitted as the new page
-        @param page Page to submit the new text to
+        Titles of the pages that this candidate may need to
+        check the existence of, such that they can be resolved
+        in batches beforehand.
+        """
+        titles = [fileNameFromTitle(self.page.title())]
+        for results in self.scan().verified:
+            # Alternatives of the verified result
+            if len(results) > 5 and len(results[5]):
+                titles.append(results[5])
+        return titles
+
+    def edit(self,page,transform,comment,create=False,batch=True,step=None):
+        """
+        Change a page. Edits of pages that several candidates may change
+        are collected by the G_EditBatch and done once per page,
+        with batch=False or without a batch they are done right away.
+
+        The change is given as a transformation of the text, such that it
+        can be done again on the new text if someone else edited the page
+        at the same time.
+
+        @param page Page to change
+        @param transform Function from the old to the new text of the page,
+                         it must leave the text unchanged if there is nothing to do
+                         and return None if the change could not be made
         @param comment The edit comment
+        @param create If the page may be created
+        @param batch If the edit may be delayed and combined with others
+        @param step Name of the parking step doing the edit, it is journaled as done once saved
         """
+        step = (self.page.title(),step) if step else None
+        if batch and G_EditBatch:
+            G_EditBatch.add(page,transform,comment,create,step)
+            return
 
-        out("\n About to commit changes to: '%s'" % page.title())
+        EditBatch().add(page,transform,comment,create,step).flush()
+        if page.title() == self.page.title():
+            # The old scan no longer describes the page
+            self._scan = None
+            self._imgCount = None
 
-        # Show the diff
-        for line in difflib.context_diff(old_text.splitlines(1), new_text.splitlines(1)):
-            if line.startswith('+ '):
-                out(line,newline=False, color="lightgreen")
-            elif line.startswith('- '):
-                out(line,newline=False, color="lightred")
-            elif line.startswith('! '):
-                out(line,newline=False, color="lightyellow")
-            else:
-                out(line,newline=False)
-        out("\n")
+    def append(self,page,text,comment,marker,section=None,batch=True,step=None):
+        """
+        Append text to a page without downloading it.
 
-        if G_Dry:
-            choice = 'n'
-        elif G_Auto:
-            choice = 'y'
-        else:
-            choice = pywikibot.inputChoice(
-                u"Do you want to accept these changes to '%s' with comment '%s' ?" % ( page.title(), comment) ,
-                ['Yes', 'No', "Quit"],
-                ['y', 'N', 'q'], 'N')
-
-        if choice == 'y':
-            page.put(new_text, comment=comment, watchArticle=True, minorEdit=False );
-        elif choice == 'q':
-            out("Aborting.")
-            sys.exit(0)
+        To find out if the text is already there, which can happen if
+        the process have been previously interrupted, we ask the api
+        whether the page uses what marker points to instead of
+        searching the text of the page.
+
+        @param page Page to append to, it is created if it does not exist
+        @param text The text to add
+        @param comment The edit comment
+        @param marker A tuple ('templates',title) or ('images',title), used
+                      by the page if text has already been added. A regexp can
+                      be given as a third item, then the text of the page is
+                      searched for it too if the page uses title.
+        @param section If given text is added in a new section with this title
+        @param batch If the edit may be delayed and combined with others
+        @param step Name of the parking step doing the edit, see edit()
+        """
+        step = (self.page.title(),step) if step else None
+        if batch and G_EditBatch:
+            G_EditBatch.append(page,text,comment,marker,section,step)
         else:
-            out("Changes to '%s' ignored" % page.title())
+            EditBatch().append(page,text,comment,marker,section,step).flush()
+
+    def stepDone(self,step):
+        """
+        Check if the parking step has already been done for this
+        candidate, can happen if the process have been previously
+        interrupted. The journal knows without looking at any page.
+        """
+        if G_Journal.isDone(self.page.title(),step):
+            out("Skipping %s for '%s', already done." % (step,self.cleanTitle()), color="lightred")
+            return True
+        return False
 
 
 class FPCandidate(Candidate):
     """A candidate up for promotion"""
 
     def __init__(self, page):
-        Candidate.__init__(self,page,SupportR,OpposeR,NeutralR,"featured","not featured",ReviewedTemplateR,CountedTemplateR,VerifiedResultR)
+        Candidate.__init__(self,page,SupportR,OpposeR,NeutralR,FPCVotes,"featured","not featured",ReviewedTemplateR,CountedTemplateR,VerifiedResultR)
         self._listPageName = "Commons:Featured picture candidates/candidate list"
 
     def getResultString(self):
@@ -835,6 +2676,14 @@ class FPCandidate(Candidate):
         else:
             return "Closing for review (%d support, %d oppose, %d neutral, featured=%s)" % (self._pro,self._con,self._neu,"yes" if self.isPassed() else "no")
 
+    def neededTitles(self):
+        titles = Candidate.neededTitles(self)
+        for results in self.scan().verified:
+            fcategory = re.sub(r'#.*','',results[4])
+            if len(fcategory):
+                titles.append("Commons:Featured pictures/" + fcategory)
+        return titles
+
     def handlePassedCandidate(self,results):
 
         # Strip away any eventual section
@@ -844,7 +2693,7 @@ class FPCandidate(Candidate):
         # Check if we have an alternative for a multi image
         if self.imageCount() > 1:
             if len(results)>5 and len(results[5]):
-                if not pywikibot.Page(pywikibot.Site(), results[5]).exists():
+                if not G_Exists.exists(results[5]):
                     out("%s: (ignoring, specified alternative not found)" % results[5])
                 else:
                     self._alternative = results[5]
@@ -856,6 +2705,9 @@ class FPCandidate(Candidate):
         if not len(fcategory):
             out("%s: (ignoring, category not set)" % self.cutTitle())
             return
+        if not G_Exists.exists("Commons:Featured pictures/" + fcategory):
+            out("%s: (ignoring, no such category '%s')" % (self.cutTitle(),fcategory))
+            return
         self.addToFeaturedList(re.search(r'(.*?)(?:/|$)',fcategory).group(1))
         self.addToCategorizedFeaturedList(fcategory)
         self.addAssessments()
@@ -867,7 +2719,7 @@ class DelistCandidate(Candidate):
     """A delisting candidate"""
 
     def __init__(self, page):
-        Candidate.__init__(self,page,DelistR,KeepR,NeutralR,"delisted","not delisted",DelistReviewedTemplateR,DelistCountedTemplateR,VerifiedDelistResultR)
+        Candidate.__init__(self,page,DelistR,KeepR,NeutralR,DelistVotes,"delisted","not delisted",DelistReviewedTemplateR,DelistCountedTemplateR,VerifiedDelistResultR)
         self._listPageName = "Commons:Featured picture candidates/removal"
 
     def getResultString(self):
@@ -891,64 +2743,230 @@ class DelistCandidate(Candidate):
         # if we are we will soon be rotated away anyway.
         # So just check and remove the candidate from any category pages
 
-        references = self.getImagePage().getReferences(withTemplateInclusion=False)
-        for ref in references:
-            if ref.title().startswith("Commons:Featured pictures/"):
-                if ref.title().startswith("Commons:Featured pictures/chronological"):
+        titles = G_Galleries.pages(self.fileName())
+        if titles is None:
+            out("No gallery index, run -buildindex to avoid looking up the references of '%s'" % self.fileName(), color="lightyellow")
+            titles = [ref.title() for ref in self.getImagePage().getReferences(withTemplateInclusion=False)]
+
+        for title in titles:
+            if normalTitle(title).startswith(GalleryPrefix):
+                ref = pywikibot.Page(pywikibot.Site(),title)
+                # One step per list page
+                step = "removeFromFeaturedLists:" + ref.title()
+                if self.stepDone(step):
+                    continue
+                if normalTitle(title).startswith(GalleryPrefix + "chronological"):
                     out("Adding delist note to %s" % ref.title())
-                    old_text = ref.get(get_redirect=True)
                     now = datetime.datetime.utcnow()
-                    new_text = re.sub(r"(([Ff]ile|[Ii]mage):%s.*)\n" % wikipattern(self.cleanTitle(keepExtension=True)),r"\1 '''Delisted %d-%02d-%02d (%s-%s)'''\n" % (now.year,now.month,now.day,results[1],results[0]), old_text)
-                    self.commit(old_text,new_text,ref,"Delisted [[%s]]" % self.fileName() )
+                    note = " '''Delisted %d-%02d-%02d (%s-%s)'''" % (now.year,now.month,now.day,results[1],results[0])
+                    self.edit(ref,self._delistNote(note),"Delisted [[%s]]" % self.fileName(),step=step)
                 else:
-                    old_text = ref.get(get_redirect=True)
-                    new_text = re.sub(r"([[)?([Ff]ile|[Ii]mage):%s.*\n" % wikipattern(self.cleanTitle(keepExtension=True)),'', old_text)
-                    self.commit(old_text,new_text,ref,"Removing [[%s]]" % self.fileName() )
+                    self.edit(ref,self._delistRemove,"Removing [[%s]]" % self.fileName(),step=step)
+
+    def _delistNote(self,note):
+        """A transform adding note to the lines of the chronological galleries showing the file"""
+        def annotate(old_text):
+            gallery = GalleryPage(old_text)
+            # The note is only added once
+            if note in old_text or not gallery.annotate(self.fileName(),note):
+                return old_text
+            return gallery.text()
+        return annotate
+
+    def _delistRemove(self,old_text):
+        """A transform removing the lines of a gallery showing the file"""
+        gallery = GalleryPage(old_text)
+        if not gallery.remove(self.fileName()):
+            return old_text
+        return gallery.text()
 
     def removeAssessments(self):
         """Remove FP status from an image"""
 
+        if self.stepDone("removeAssessments"):
+            return
+
         imagePage = self.getImagePage()
-        old_text = imagePage.get(get_redirect=True)
 
-        # First check for the old {{Featured picture}} template
-        new_text = re.sub(r'{{[Ff]eatured[ _]picture}}','{{Delisted picture}}',old_text)
+        def remove(old_text):
+            # First check for the old {{Featured picture}} template
+            new_text = re.sub(r'{{[Ff]eatured[ _]picture}}','{{Delisted picture}}',old_text)
+
+            # Then check for the assessments template
+            # The replacement string needs to use the octal value for the char '2' to
+            # not confuse python as '\12\2' would obviously not work
+            return re.sub(r'({{[Aa]ssessments\s*\|.*(?:com|featured)\s*=\s*)1(.*?}})',r'\1\062\2',new_text)
+
+        self.edit(imagePage,remove,"Delisted",batch=False,step="removeAssessments")
+
+
+def commit(old_text,new_text,page,comment,baserevid=None):
+    """
+    This will commit new_text to the page
+    and unless running in automatic mode it
+    will show you the diff and ask you to accept it.
+    Returns the id of the new revision, or None if the page was not saved.
+    Raises pywikibot.EditConflict if the page is no longer at baserevid.
+
+    @param old_text Used to show the diff
+    @param new_text Text to be submitted as the new page
+    @param page Page to submit the new text to
+    @param comment The edit comment
+    @param baserevid The revision old_text was taken from, None if the page is new
+    """
+
+    out("\n About to commit changes to: '%s'" % page.title())
+
+    # Show the diff
+    for line in difflib.context_diff(old_text.splitlines(1), new_text.splitlines(1)):
+        if line.startswith('+ '):
+            out(line,newline=False, color="lightgreen")
+        elif line.startswith('- '):
+            out(line,newline=False, color="lightred")
+        elif line.startswith('! '):
+            out(line,newline=False, color="lightyellow")
+        else:
+            out(line,newline=False)
+    out("\n")
+
+    if not confirm(page,comment):
+        return None
+
+    if baserevid:
+        result = G_Api.edit(page.title(),comment,text=new_text,baserevid=baserevid,nocreate=1)
+    else:
+        result = G_Api.edit(page.title(),comment,text=new_text,createonly=1)
+    saved(page)
+    G_Galleries.update(page.title(),new_text,result.get('newrevid'))
+    return result.get('newrevid')
 
-        # Then check for the assessments template
-        # The replacement string needs to use the octal value for the char '2' to
-        # not confuse python as '\12\2' would obviously not work
-        new_text = re.sub(r'({{[Aa]ssessments\s*\|.*(?:com|featured)\s*=\s*)1(.*?}})',r'\1\062\2',new_text)
+def commitAppend(page,text,comment,section=None):
+    """
+    Like commit() but just appends text to the page
+    without downloading or uploading the whole page.
+    Returns the id of the new revision, or None if the text was not added.
+
+    @param page Page to append to
+    @param text The text to add
+    @param comment The edit comment
+    @param section If given the text is added in a new section with this title
+    """
 
-        self.commit(old_text,new_text,imagePage,"Delisted")
+    out("\n About to append to: '%s'" % page.title())
+    if section:
+        out("+ == %s ==" % section, color="lightgreen")
+    for line in text.splitlines(1):
+        out("+ %s" % line, newline=False, color="lightgreen")
+    out("\n")
 
+    if not confirm(page,comment):
+        return None
+
+    if section:
+        result = G_Api.edit(page.title(),comment,section='new',sectiontitle=section,text=text,nocreate=1)
+    else:
+        result = G_Api.edit(page.title(),comment,appendtext=text)
+    saved(page)
+    return result.get('newrevid')
+
+def confirm(page,comment):
+    """
+    Unless running in automatic mode ask if the changes shown
+    should be saved to page, returns True if they should.
+    """
+    if G_Dry:
+        choice = 'n'
+    elif G_Auto:
+        choice = 'y'
+    else:
+        choice = pywikibot.inputChoice(
+            u"Do you want to accept these changes to '%s' with comment '%s' ?" % ( page.title(), comment) ,
+            ['Yes', 'No', "Quit"],
+            ['y', 'N', 'q'], 'N')
+
+    if choice == 'y':
+        return True
+    elif choice == 'q':
+        out("Aborting.")
+        sys.exit(0)
+    else:
+        out("Changes to '%s' ignored" % page.title())
+        return False
+
+def saved(page):
+    """Forget what we knew about page after saving it"""
+    G_PageCache.invalidate(page)
+    G_Revisions.invalidate(page.title())
+    G_Exists.created(page.title())
+
+def fileKey(fileName):
+    """The name of a file as the api writes it, with or without a namespace"""
+    return "File:" + normalTitle(re.sub(r'^\s*(?:[Ff]ile|[Ii]mage)\s*:\s*','',fileName))
+
+def normalTitle(title):
+    """The title as the api writes it"""
+    title = title.replace('_',' ').strip()
+    return title[:1].upper() + title[1:]
+
+def pageContains(title,markers):
+    """
+    Asks the api which of the markers the page title uses, without
+    downloading the page. Markers are tuples ('templates',title) for
+    transcluded pages or ('images',title) for files, returns the set
+    of the normalized titles found.
+    """
+    targets = {}
+    for prop,target in markers:
+        targets.setdefault(prop,[]).append(normalTitle(target))
+
+    found = set()
+    for prop,names in targets.items():
+        key = {'templates':'tltemplates','images':'imimages'}[prop]
+        for batch in batches(names):
+            for t,page in G_Api.queryPages([title],prop=prop,**{key:"|".join(batch)}):
+                for used in page.get(prop,[]):
+                    found.add(normalTitle(used['title']))
+    return found
 
 def wikipattern(s):
     """Return a string that can be matched against different way of writing it on wikimedia projects"""
-    def rep(m):
-        if m.group(0) == ' ' or m.group(0) == '_':
-            return "[ _]";
-        elif m.group(0) == '(' or m.group(0) == ')' or m.group(0) == '*':
-            return '\\' + m.group(0)
-
-    return re.sub('[ _\()*]',rep,s)
+    for old,new in WikiPatternTable:
+        s = s.replace(old,new)
+    return s
 
 def out(text, newline=True, date=False, color=None):
     """Just output some text to the consoloe or log"""
     if color:
         text = "\03{%s}%s\03{default}" % (color, text)
     dstr = "%s: " % datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") if date and not G_LogNoTime else ""
-    pywikibot.output("%s%s" % (dstr,text) , toStdout=True, newline=newline)
+    write("%s%s" % (dstr,text), newline)
+
+def write(line, newline=True):
+    """
+    Writes a line to the console, or collects it if the
+    current thread is checking a candidate in a CandidatePool,
+    or the current process is recounting one, see recount()
+    """
+    lines = getattr(G_Output,'lines',None)
+    if lines is not None:
+        lines.append((line,newline))
+    else:
+        pywikibot.output(line, toStdout=True, newline=newline)
 
 def findCandidates(page_url, delist):
     """This finds all candidates on the main FPC page"""
 
-    page = pywikibot.Page(pywikibot.Site(), page_url)
+    site = pywikibot.Site()
+
+    # Asked through G_Api, such that G_Scheduler knows about it
+    titles = []
+    for t,page in G_Api.queryPages([page_url],prop='templates',tlnamespace=4,tllimit='max'):
+        titles.extend(template['title'] for template in page.get('templates',[]))
 
     candidates = []
-    templates = page.templates()
-    for template in templates:
-        title = template.title()
+    for title in titles:
         if title.startswith(candPrefix):
+            template = pywikibot.Page(site, title)
             # out("Adding '%s' (delist=%s)" % (title,delist))
             if delist:
                 candidates.append(DelistCandidate(template))
@@ -959,45 +2977,462 @@ def findCandidates(page_url, delist):
             #out("Skipping '%s'" % title)
     return candidates
 
-def checkCandidates(check,page,delist):
+def fileNameFromTitle(title):
     """
-    Calls a function on each candidate found on the specified page
+    The name of the nominated file as given by the title of
+    the candidate page, this also removes any possible crap
+    between the prefix and the actual start of the filename.
+    """
+    return FileNameR.sub(r'\2',title)
 
-    @param check  A function in Candidate to call on each candidate
-    @param page   A page containing all candidates
-    @param delist Boolean, telling whether this is delistings of fpcs
+def parseTimestamp(ts):
+    """Parse a timestamp as returned by the api into a datetime in UTC"""
+    return datetime.datetime.strptime(ts,TimestampFormat)
+
+def batches(seq,size=None):
+    """Splits seq into lists of at most size items (ApiBatchSize by default)"""
+    size = size or ApiBatchSize
+    return [seq[i:i+size] for i in range(0,len(seq),size)]
+
+def revisionText(rev):
+    """The wikitext of a revision as returned by the api"""
+    if 'slots' in rev:
+        rev = rev['slots']['main']
+    return rev.get('*',rev.get('content'))
+
+def concurrentMap(func,items,limit=None):
+    """
+    Returns [func(item) for item in items] but with up to limit
+    (G_Concurrency by default) of the calls running at the same
+    time in threads. This is meant for api reads that do not
+    depend on each other, the first exception raised by func
+    is raised again once all calls are done.
+    """
+    items = list(items)
+    limit = min(limit or G_Concurrency,len(items))
+    if limit <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors  = []
+    todo    = Queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def work():
+        while not errors:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for i in range(limit)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout, so we still see CTRL-C
+        while thread.isAlive():
+            thread.join(0.5)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def asTuple(value):
+    """Turns the lists of a decoded json value back into tuples"""
+    if isinstance(value,list):
+        return tuple(asTuple(v) for v in value)
+    return value
+
+def preloadCandidates(candidates):
     """
-    candidates = findCandidates(page,delist)
+    Fetches the text of all candidates in batches
+    and adds it to the page cache, such that checking them
+    does not need one request per candidate.
+    Candidates that did not change since the last run are
+    taken from the page store.
+    """
+    titles = [candidate.page.title() for candidate in candidates]
+    if not titles:
+        return
 
-    def containsPattern(candidate):
-        return candidate.cleanTitle().lower().find(G_MatchPattern.lower()) != -1
+    out("Preloading %d candidates..." % len(titles), date=True)
+    G_PageStore.load(titles)
 
-    candidates = filter(containsPattern,candidates)
+def preloadHistory(candidates):
+    """
+    Fetches the first and latest revisions of all candidates
+    and their nominated files in batches, this is what
+    creationTime(), nominator(), uploader() and
+    daysSinceLastEdit() are based on.
+    """
+    titles = []
+    for candidate in candidates:
+        titles.append(candidate.page.title())
+        titles.append(fileNameFromTitle(candidate.page.title()))
+    G_Revisions.load(titles)
 
-    tot = len(candidates)
-    i = 1
+def preloadExistence(candidates):
+    """
+    Resolves whether the files, alternatives and category
+    pages needed by the candidates exist, in batches.
+    """
+    titles = []
     for candidate in candidates:
+        try:
+            titles.extend(candidate.neededTitles())
+        except pywikibot.NoPage:
+            pass
+    G_Exists.resolve(titles)
+
+def preloadVoters(candidates):
+    """
+    Looks up all users that signed votes on the candidates at once,
+    such that reportVoters() can tell which of them may not vote.
+    """
+    names = []
+    for candidate in candidates:
+        try:
+            names.extend(user for kind,user in candidate.voters() if user)
+        except pywikibot.NoPage:
+            pass
+    G_Users.load(names)
+
+def checkCandidates(check,page,delist,history=True,voters=False,deadlines=False):
+    """
+    Calls a function on each candidate found on the specified page
+
+    @param check     A function in Candidate to call on each candidate
+    @param page      A page containing all candidates
+    @param delist    Boolean, telling whether this is delistings of fpcs
+    @param history   Boolean, preload the revision history used by the check
+    @param voters    Boolean, look up the users that voted
+    @param deadlines Boolean, only call check on the candidates that are due, and keep the next
+                     deadline of those check returned False for, see Deadlines
+    """
+    candidates = filter(containsPattern,findCandidates(page,delist))
+    if deadlines and not G_MatchPattern:
+        G_Deadlines.keepOnly(normalTitle(page),[normalTitle(c.page.title()) for c in candidates])
+    runChecks(check,candidates,history,voters,deadlines)
+
+def containsPattern(candidate):
+    """Check if the title of candidate contains the pattern given with -match"""
+    return candidate.cleanTitle().lower().find(G_MatchPattern.lower()) != -1
+
+def runChecks(check,candidates,history=True,voters=False,deadlines=False):
+    """
+    Calls a function on each of candidates, after preloading
+    what it needs, see checkCandidates() for the parameters
+    """
+    preloadCandidates(candidates)
+
+    if deadlines:
+        revisions = {}
+        for candidate in candidates:
+            revisions[candidate] = G_PageCache.revision(candidate.page)
+        due = [c for c in candidates if G_Deadlines.isDue(normalTitle(c.page.title()),revisions[c])]
+        if len(due) < len(candidates):
+            out("Skipping %d candidates that are not due, see -next" % (len(candidates) - len(due)))
+        candidates = due
+
+        # Only the candidates check found nothing to do for get a deadline,
+        # the others were edited, or would have been if not for -dry or the operator
+        settled = set()
+        def checkSettled(candidate,check=check):
+            if check(candidate) is False:
+                settled.add(candidate)
+        check = checkSettled
+    preloadExistence(candidates)
+    if history:
+        preloadHistory(candidates)
+    if voters:
+        preloadVoters(candidates)
+
+    if G_Threads:
+        CandidatePool(G_Threads).run(check,candidates)
+    else:
+        tot = len(candidates)
+        i = 1
+        for candidate in candidates:
 
-        if not G_Threads:
             out("(%03d/%03d) " %(i,tot), newline=False, date=True)
 
-        try:
-            if G_Threads:
-                while threading.activeCount() >= config.max_external_links:
-                    time.sleep(0.1)
-                thread = ThreadCheckCandidate(candidate,check)
-                thread.start()
-            else:
+            try:
                 check(candidate)
+            except pywikibot.NoPage, error:
+                out("No such page '%s'" % error, color="lightred")
+            except pywikibot.LockedPage, error:
+                out("Page is locked '%s'" % error, color="lightred")
+
+            i += 1
+            if G_Abort:
+                break
+
+    if deadlines and not G_Abort:
+        for candidate in candidates:
+            if candidate not in settled:
+                continue
+            try:
+                due = candidate.nextCheck()
+            except pywikibot.NoPage:
+                continue
+            G_Deadlines.set(normalTitle(candidate.page.title()),revisions[candidate],
+                            normalTitle(candidate._listPageName),due)
+
+def checkDump(check,path,months):
+    """
+    Calls a function on each candidate of the logs of months, as
+    found in the xml dump at path, without using the network.
+    The dump is read twice, first for the logs and then for the
+    candidates listed in them, as pages come in any order.
+
+    @param check  A function in Candidate to call on each candidate
+    @param path   The dump, f.ex. commonswiki-latest-pages-articles.xml.bz2
+    @param months A list of (year,month) tuples, see monthRange()
+    """
+    site = pywikibot.Site()
+    for title,revid,text,year in dumpCandidates(path,months):
+        candidate = FPCandidate(pywikibot.Page(site,title))
+        G_PageCache.seed(title,revid,text)
+        try:
+            check(candidate)
         except pywikibot.NoPage, error:
             out("No such page '%s'" % error, color="lightred")
-        except pywikibot.LockedPage, error:
-            out("Page is locked '%s'" % error, color="lightred")
-
-        i += 1
+        # Keep just the candidate we are at in memory
+        G_PageCache.invalidate(candidate.page)
         if G_Abort:
             break
 
+def dumpCandidates(path,months):
+    """
+    Yields (title,revid,text,year) for the candidates of the logs of months in
+    the dump at path that match -match, year is the year of the log, see checkDump()
+    """
+    logs = dict((normalTitle("%sLog/%s %d" % (candPrefix,Month[month],year)),year) for year,month in months)
+    out("Reading the logs of %d months from '%s'..." % (len(logs),path), date=True)
+    wanted = {}
+    found  = 0
+    for title,revid,text in dumpPages(path,lambda title: title in logs):
+        found += 1
+        for name in TemplateNameR.findall(text):
+            name = normalTitle(name)
+            if name.startswith(candPrefix):
+                wanted[name] = logs[title]
+    out("Found %d of the logs, reading their %d candidates..." % (found,len(wanted)), date=True)
+
+    site = pywikibot.Site()
+    for title,revid,text in dumpPages(path,lambda title: title in wanted):
+        if containsPattern(FPCandidate(pywikibot.Page(site,title))):
+            yield title,revid,text,wanted[title]
+
+def storedCandidates():
+    """
+    Yields (title,revid,text,year) for the featured picture candidates kept
+    in the page store that match -match, year is the year the candidate was
+    created in, None if the store does not know it
+    """
+    site = pywikibot.Site()
+    for title,revid,text in G_PageStore.pages(candPrefix):
+        name = title[len(candPrefix):].lower()
+        if not (name.startswith("file:") or name.startswith("image:")):
+            # Logs, lists and delisting candidates
+            continue
+        if containsPattern(FPCandidate(pywikibot.Page(site,title))):
+            first = G_Revisions.stored(title)
+            yield title,revid,text,first[0].year if first else None
+
+def recountCandidates(items,procs):
+    """
+    Runs compareResultToCount on the candidates in items in procs processes,
+    and summarizes the results, see recountReport(). items are (title,revid,
+    text,year) tuples as given by dumpCandidates() and storedCandidates().
+    At most RecountQueue candidates per process are handed out at a time, such
+    that the texts of all candidates are never in memory at the same time.
+    """
+    pool = multiprocessing.Pool(procs,initializer=recountWorker)
+    records = []
+    pending = collections.deque()
+    start = time.time()
+
+    def collect():
+        lines,record = pending.popleft().get()
+        for line,newline in lines:
+            write(line,newline)
+        records.append(record)
+
+    try:
+        for title,revid,text,year in items:
+            pending.append(pool.apply_async(recount,((title,text,year),)))
+            if len(pending) >= procs * RecountQueue:
+                collect()
+            if G_Abort:
+                break
+        while pending and not G_Abort:
+            collect()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    recountReport(records,procs,time.time() - start)
+
+def recountWorker():
+    """Started in each process of recountCandidates()"""
+    # CTRL-C is handled by the main process
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    # An sqlite connection can not be shared with the main process
+    G_Store._db = None
+
+def recount(item):
+    """
+    Runs compareResultToCount on the text of a candidate in a process of
+    recountCandidates(), item is a (title,text,year) tuple. Returns the
+    output and a (title,year,status,difference,seconds) record.
+    """
+    title,text,year = item
+    start = time.time()
+    G_Output.lines = []
+    try:
+        candidate = FPCandidate(pywikibot.Page(pywikibot.Site(),title))
+        candidate.scanText(text)
+        status,difference = candidate.compareResultToCount()
+    finally:
+        lines = G_Output.lines
+        G_Output.lines = None
+    return lines,(title,year,status,difference,time.time() - start)
+
+def recountReport(records,procs,seconds):
+    """Console output of the accuracy per year, the differences found and the slowest pages"""
+    years = collections.OrderedDict()
+    differences = collections.Counter()
+    for title,year,status,difference,spent in sorted(records,key=lambda r: (r[1] is None,r[1])):
+        counts = years.setdefault(year,collections.Counter())
+        counts[status if status in ("OK","FAIL") else "ignored"] += 1
+        if difference:
+            differences[difference] += 1
+
+    out("Recounted %d candidates in %.1f s with %d processes (%.1f per second)" %
+        (len(records),seconds,procs,len(records) / max(seconds,0.001)), color="lightblue")
+    out("Year      OK   FAIL  Ignored  Accuracy")
+    total = sum(years.values(),collections.Counter())
+    for year,counts in years.items() + [("Total",total)]:
+        checked = counts["OK"] + counts["FAIL"]
+        accuracy = "%7.2f%%" % (100.0 * counts["OK"] / checked) if checked else "       -"
+        out("%-7s %5d  %5d  %7d  %s" % (year if year is not None else "Unknown",
+                                        counts["OK"],counts["FAIL"],counts["ignored"],accuracy))
+
+    if differences:
+        out("Most common differences (+ counted more, - counted less than the result):")
+        for difference,n in differences.most_common(RecountTop):
+            out("%7d  %s" % (n,difference))
+
+    out("Slowest pages:")
+    for title,year,status,difference,spent in heapq.nlargest(RecountTop,records,key=lambda r: r[4]):
+        out("%7.3f s  %s" % (spent,title.replace(candPrefix,"")))
+
+def dumpPages(path,wanted):
+    """
+    Yields (title,revid,text) for the pages of the xml dump at path
+    for which wanted(title) is true, with the last revision in the dump.
+    The dump is streamed, such that it does not matter how large it is,
+    a dump ending in .bz2 is decompressed while it is read.
+    """
+    dump = DumpFile(path) if path.endswith('.bz2') else open(path,'rb')
+    try:
+        root  = None
+        title = None
+        last  = None
+        for event,elem in ElementTree.iterparse(dump,events=('start','end')):
+            if root is None:
+                root = elem
+            if event == 'start':
+                continue
+            # The tags are qualified by the namespace of the export format
+            ns,tag = elem.tag[:elem.tag.find('}') + 1],elem.tag[elem.tag.find('}') + 1:]
+            if tag == 'title':
+                title = elem.text
+                last  = None
+            elif tag == 'revision':
+                if wanted(title):
+                    last = (int(elem.findtext(ns + 'id')),elem.findtext(ns + 'text') or u"")
+                elem.clear()
+            elif tag == 'page':
+                if last:
+                    yield title,last[0],last[1]
+                last = None
+                root.clear()
+    finally:
+        dump.close()
+
+def monthRange(spec):
+    """
+    The (year,month) tuples of a range of months given as
+    'yyyy-mm' or 'yyyy-mm:yyyy-mm', raises ValueError if
+    it is not a range like that
+    """
+    parts = [[int(n) for n in part.split('-')] for part in spec.split(':')]
+    if len(parts) == 1:
+        parts.append(parts[0])
+    (year,month),(lastYear,lastMonth) = parts
+    if not 1 <= month <= 12 or not 1 <= lastMonth <= 12:
+        raise ValueError(spec)
+    months = []
+    while (year,month) <= (lastYear,lastMonth):
+        months.append((year,month))
+        year,month = (year + 1,1) if month == 12 else (year,month + 1)
+    return months
+
+def measureSpeedup(page,delist):
+    """
+    Runs the -info check on all candidates of page with
+    pools of SpeedupWorkers threads and reports the time
+    taken by each of them compared to a single thread.
+    The api reads before the check, the preloading included,
+    are run as many at a time as there are threads.
+    Each round starts with empty caches and an empty store
+    in a temporary directory, such that all of them fetch
+    and scan the same pages.
+    """
+    global G_Threads, G_Concurrency, G_PageCache, G_Revisions, G_Exists, G_PageStore, G_Users, G_Scheduler
+
+    kept    = (G_Threads,G_Concurrency,G_PageCache,G_Revisions,G_Exists,G_PageStore,G_Users,G_Scheduler)
+    folder  = tempfile.mkdtemp(prefix="fpcbot-speedup-")
+    timings = []
+    try:
+        for workers in SpeedupWorkers:
+            store = Store(os.path.join(folder,"round%d.db" % workers))
+            G_PageCache   = PageCache()
+            G_Revisions   = RevisionInfo(store)
+            G_Exists      = PageExistence()
+            G_PageStore   = PageStore(store)
+            G_Users       = UserInfo(store)
+            G_Scheduler   = RequestScheduler()
+            G_Threads     = workers
+            G_Concurrency = workers
+
+            G_Output.lines = []
+            start = time.time()
+            try:
+                checkCandidates(Candidate.printAllInfo,page,delist)
+            finally:
+                G_Output.lines = None
+                if store._db:
+                    store._db.close()
+            timings.append((workers,time.time() - start))
+            if G_Abort:
+                break
+    finally:
+        G_Threads,G_Concurrency,G_PageCache,G_Revisions,G_Exists,G_PageStore,G_Users,G_Scheduler = kept
+        shutil.rmtree(folder,ignore_errors=True)
+
+    out("Threads   Time (s)  Speedup")
+    for workers,seconds in timings:
+        out("%7d  %9.2f  %7.2f" % (workers,seconds,timings[0][1] / max(seconds,0.001)))
+
 def filter_content(text):
     """
     Will filter away content that should not be parsed
@@ -1009,15 +3444,413 @@ def filter_content(text):
     * Html comments
 
     """
-    text = strip_tag(text,"s")
-    text = strip_tag(text,"nowiki")
-    text = re.sub(r'(?s){{\s*[Ii]mageNote\s*\|.*?}}.*{{\s*[iI]mageNoteEnd.*?}}','',text)
-    text = re.sub(r'(?s)<!--.*?-->','',text)
-    return text
+    return "".join(text[start:end] for at,start,end in filter_spans(text))
+
+def filter_spans(text):
+    """
+    Finds the parts of text that filter_content() keeps in one scan
+    from left to right, returns them as a list of (at,start,end)
+    tuples where text[start:end] is found at position 'at' of the
+    filtered text.
+
+    Struck out text can be nested, <s> is removed up to the </s>
+    that matches it. Nothing is looked for in comments, nowiki
+    and image notes, the latter end at the first {{ImageNoteEnd}}.
+    An opening that is never closed is kept as text, to know that
+    we remember the position from where each kind has no end
+    such that no part of the text is searched twice for it.
+    """
+    spans = []
+    keep = 0         # Start of the text we keep
+    pos = 0
+    depth = 0        # Of nested <s>
+    noEnd = {}       # Kind -> position from where openings of it are never closed
+
+    while True:
+        m = FilterTokenR.search(text,pos)
+        if not m:
+            if not depth:
+                break
+            # A <s> that is still open at the end
+            del spans[struck[1]:]
+            keep = struck[0]
+            if lastEnd >= 0:
+                # Remove up to the last </s> we saw
+                spans.append((keep,struck[2]))
+                keep = pos = lastEnd
+            else:
+                noEnd['s'] = pos = struck[2]
+            depth = 0
+            continue
+
+        token = m.group(0)
+        if token.startswith('{{'):
+            token = '{{ImageNote'
+        if token == '</s>':
+            if depth:
+                depth -= 1
+                lastEnd = m.end()
+                if not depth:
+                    keep = m.end()
+            pos = m.end()
+            continue
+
+        if token == '<s>':
+            if not depth:
+                if noEnd.get('s',len(text)) <= m.start() or text.find('</s>',m.end()) == -1:
+                    noEnd.setdefault('s',m.start())
+                    pos = m.end()
+                    continue
+                # To undo the removal if it is never closed
+                struck = (keep,len(spans),m.start())
+                lastEnd = -1
+                spans.append((keep,m.start()))
+            depth += 1
+            pos = m.end()
+            continue
+
+        # Comments, nowiki and image notes
+        end = -1
+        if noEnd.get(token,len(text)) > m.start():
+            if token == '<!--':
+                end = text.find('-->',m.end())
+                end = end + 3 if end >= 0 else -1
+            elif token == '<nowiki>':
+                end = text.find('</nowiki>',m.end())
+                end = end + 9 if end >= 0 else -1
+            else:
+                opened = text.find('}}',m.end())
+                n = ImageNoteEndR.search(text,opened) if opened >= 0 else None
+                end = n.end() if n else -1
+        if end == -1:
+            noEnd.setdefault(token,m.start())
+            pos = m.end()
+            continue
+        if not depth:
+            spans.append((keep,m.start()))
+            keep = end
+        pos = end
+
+    spans.append((keep,len(text)))
+    found = []
+    at = 0
+    for start,end in spans:
+        if end > start:
+            found.append((at,start,end))
+            at += end - start
+    return found
+
+def originalPositions(spans,positions):
+    """
+    Maps positions in the text given by filter_content() to
+    the positions in the original text, spans are as given by
+    filter_spans() and positions must be sorted.
+    """
+    mapped = []
+    i = 0
+    for pos in positions:
+        while i + 1 < len(spans) and spans[i+1][0] <= pos:
+            i += 1
+        if spans:
+            mapped.append(spans[i][1] + pos - spans[i][0])
+        else:
+            mapped.append(pos)
+    return mapped
+
+def scanTokens(text,tokenR,regexes,lineRegexes=()):
+    """
+    Scans text once from left to right and returns a list
+    with the matches found for each of the regexps.
+
+    The regexps are only tried at the positions found by tokenR
+    so each of them must only be able to match starting at such
+    a token. For those the result is identical to what re.finditer
+    would have found.
+    The lineRegexes are tried once at the start of each line
+    containing a token, for them we only record the first match.
+    """
+    found = [[] for r in regexes]
+    nextPos = [0] * len(regexes)
+    lineFound = [None] * len(lineRegexes)
+    lineEnd = -1
+
+    for token in tokenR.finditer(text):
+        pos = token.start()
+        for i,regex in enumerate(regexes):
+            if pos >= nextPos[i]:
+                m = regex.match(text,pos)
+                if m:
+                    found[i].append(m)
+                    nextPos[i] = m.end()
+
+        if lineRegexes and pos > lineEnd:
+            lineStart = text.rfind('\n',0,pos) + 1
+            lineEnd = text.find('\n',pos)
+            if lineEnd == -1:
+                lineEnd = len(text)
+            for i,regex in enumerate(lineRegexes):
+                if lineFound[i] is None:
+                    lineFound[i] = regex.match(text,lineStart)
+
+    return found + lineFound
+
+def scanCandidate(text,filtered,votes,reviewedR,countedR,verifiedR):
+    """
+    Scans the wikitext of a candidate and returns a CandidateScan
+    with everything the bot needs to know about it.
+
+    Votes and the withdrawn template are found in filtered,
+    the text as returned by filter_content(), everything else
+    in the raw text.
+    """
+    if not text:
+        return CandidateScan(True,0,0,0,False,False,False,0,(),(),False,False,(),())
+
+    found = votes.scan(filtered)
+    pro,con,neu = found
+    withdrawn, = scanTokens(filtered,TemplateTokenR,(WithdrawnR,))
+
+    fpx,ignored,sections,images,existing,verified,reviewed,counted = \
+        scanTokens(text,PageTokenR,(FpxR,IgnoredR,SectionR,ImagesR,PreviousResultR,verifiedR),(reviewedR,countedR))
+
+    imgs = []
+    for m in images:
+        size = re.search(ImagesSizeR,m.group(0))
+        imgs.append((m.group(1),
+                      int(size.group(1)) if size else None,
+                      re.search(ImagesThumbR,m.group(0)) is not None))
+
+    return CandidateScan(False,len(pro),len(con),len(neu),
+                         len(withdrawn) > 0,len(fpx) > 0,len(ignored) > 0,
+                         len(sections),tuple(imgs),
+                         tuple(m.groups('') for m in existing),
+                         counted is not None,reviewed is not None,
+                         tuple(m.groups('') for m in verified),
+                         attributeVotes(filtered,found))
+
+def appendScan(scan,text,appended,votes,reviewedR,countedR,verifiedR):
+    """
+    Returns the CandidateScan of text + appended from the scan of text,
+    only appended is scanned. If appending can change what was found
+    in text None is returned, and the whole page has to be scanned:
+
+    * appended has markers of what filter_content() removes
+    * text ends in an unclosed template or link, see openAtEnd()
+    * the last vote in text is not signed, or signed without a timestamp,
+      as its signer may be found differently once text is added
+    """
+    if scan.empty or FilterMarkR.search(appended):
+        return None
+    if scan.voters and scan.voters[-1][1] is None:
+        return None
+    filtered = filter_content(text)
+    if openAtEnd(text) or openAtEnd(filtered):
+        return None
+    if scan.voters and not lastVoteStamped(filtered,votes):
+        return None
+
+    more = scanCandidate(appended,filter_content(appended),votes,reviewedR,countedR,verifiedR)
+    if more.empty:
+        return scan
+    return CandidateScan(False,scan.pro + more.pro,scan.con + more.con,scan.neu + more.neu,
+                         scan.withdrawn or more.withdrawn,scan.fpx or more.fpx,scan.ignored or more.ignored,
+                         scan.sections + more.sections,scan.images + more.images,
+                         scan.existing + more.existing,
+                         scan.counted or more.counted,scan.reviewed or more.reviewed,
+                         scan.verified + more.verified,
+                         scan.voters + more.voters)
+
+def compareScans(text,splits,votes,reviewedR,countedR,verifiedR):
+    """
+    Splits text at up to splits lines, and compares the scan made by
+    appendScan() from the scan of the part above with the scan of the
+    whole text. Returns how many splits were appended and scanned
+    again, and for how many of the appended the scans differ.
+    """
+    full = scanCandidate(text,filter_content(text),votes,reviewedR,countedR,verifiedR)
+
+    lines = text.split('\n')
+    step = max(1,len(lines) // splits)
+    appended = rescanned = differ = 0
+    for i in range(step,len(lines),step):
+        above = '\n'.join(lines[:i])
+        scan = scanCandidate(above,filter_content(above),votes,reviewedR,countedR,verifiedR)
+        scan = appendScan(scan,above,'\n' + '\n'.join(lines[i:]),votes,reviewedR,countedR,verifiedR)
+        if scan is None:
+            rescanned += 1
+        else:
+            appended += 1
+            if scan != full:
+                differ += 1
+    return appended,rescanned,differ
+
+def checkAppendScans():
+    """
+    Compares the scans made by appendScan() with full scans on
+    generated pages where the lines added could change a vote.
+    """
+    stamp = u" 12:00, 1 January 2012 (UTC)"
+    pages = (("Reply below a vote without timestamp",
+              u"===[[:File:X.jpg]]===\n*{{Support}} [[User:Dave|Dave]]\n*:Thanks [[User:Eve|Eve]]" + stamp),
+             ("Reply below an unsigned vote",
+              u"===[[:File:X.jpg]]===\n*{{Support}} nice\n*:Sign it [[User:Frank|Frank]]" + stamp),
+             ("Vote below a signed vote",
+              u"===[[:File:X.jpg]]===\n*{{Support}} [[User:Dave|Dave]]" + stamp +
+              u"\n*{{Oppose}} [[User:Eve|Eve]]" + stamp))
+
+    for name,text in pages:
+        appended,rescanned,differ = compareScans(text,AppendTestSplits,FPCVotes,
+                                                 ReviewedTemplateR,CountedTemplateR,VerifiedResultR)
+        out("%s: %d appended, %d scanned again (%s)" % (name,appended,rescanned,
+                                                        "DIFF %d" % differ if differ else "OK"),
+            color="lightred" if differ else None)
+
+def lastVoteStamped(text,votes):
+    """Check if the last vote in the filtered text has a timestamp after it on its line"""
+    ends = [end for found in votes.scan(text) for start,end in found]
+    if not ends:
+        return True
+    last = max(ends)
+    line = text.find('\n',last)
+    if line == -1:
+        line = len(text)
+    return bool(SignatureTimeR.search(text,last,line))
+
+def openAtEnd(text):
+    """
+    Check if a template, link or result at the end of text can go on in
+    text added below it: an unclosed template or link, an image or category
+    after the last '|' as the names of images and the category of results
+    are read up to the next '|', and a result line without the result.
+    """
+    if text.rfind('{{') > text.rfind('}}') or text.rfind('[[') > text.rfind(']]'):
+        return True
+    last = text[text.rfind('|') + 1:]
+    if ImagesR.search(last) or 'category' in last:
+        return True
+    result = text.rfind("'''result:'''")
+    return result != -1 and text.find('featured',result) == -1
 
-def strip_tag(text,tag):
-    """Will simply take a tag and remove a specified tag"""
-    return re.sub(r'(?s)<%s>.*?</%s>' % (tag,tag),'',text)
+def appendedText(text,diff):
+    """
+    The text appended to text by an edit, found from the html diff of the
+    edit as given by action=compare. None if the edit did anything else
+    than adding lines at the end of text.
+    """
+    if not diff:
+        return None
+    context = []
+    added   = []
+    hunks   = 0
+    first   = None
+    for row in diff.split('<tr')[1:]:
+        cells = [(set(kind.split()),html) for kind,html in DiffCellR.findall(row)]
+        kinds = set()
+        for kind,html in cells:
+            kinds |= kind
+        if 'diff-lineno' in kinds:
+            hunks += 1
+            m = DiffLineR.search(row)
+            first = int(m.group(1).replace(',','')) if m else None
+        elif 'diff-deletedline' in kinds:
+            return None
+        elif 'diff-addedline' in kinds:
+            added.append(diffLine([html for kind,html in cells if 'diff-addedline' in kind][0]))
+        elif 'diff-context' in kinds:
+            if added:
+                # Something was inserted above this line
+                return None
+            context.append(diffLine([html for kind,html in cells if 'diff-context' in kind][-1]))
+
+    lines = text.split('\n')
+    if hunks != 1 or not added or not context or first is None:
+        return None
+    if first - 1 + len(context) != len(lines) or lines[-len(context):] != context:
+        return None
+    return '\n' + '\n'.join(added)
+
+def diffLine(html):
+    """The wikitext of a line in the html of a diff"""
+    return G_Html.unescape(DiffTagR.sub('',html))
+
+def attributeVotes(text,votes):
+    """
+    Pairs each vote with the signature that follows it on its line, in
+    one scan of the text. A list item is one line, so replies below the
+    vote are never taken for its signature. The signature is the last
+    link to a user or user talk page before the first timestamp after the
+    vote on that line, or before the end of the line if it has no
+    timestamp, such that users the vote refers to are skipped. Returns a
+    tuple with a (kind,user) tuple for each vote in the order they are
+    found, kind is the index of the list in votes it is from. user is
+    None if there is no signature after the vote on its line.
+
+    @param text The filtered text
+    @param votes The lists of (start,end) positions of each kind of vote, see VoteMatcher
+    """
+    ordered = sorted((start,end,kind) for kind,found in enumerate(votes) for start,end in found)
+    signatures = [(m.start(),normalTitle(m.group(1))) for m in SignatureR.finditer(text)]
+    starts = [start for start,user in signatures]
+    stamps = [m.start() for m in SignatureTimeR.finditer(text)]
+
+    voters = []
+    for start,end,kind in ordered:
+        signed = text.find('\n',end)
+        if signed == -1:
+            signed = len(text)
+        t = bisect.bisect_left(stamps,end)
+        if t < len(stamps) and stamps[t] < signed:
+            signed = stamps[t]
+        s = bisect.bisect_left(starts,signed) - 1
+        user = None
+        if s >= 0 and starts[s] >= end:
+            user = signatures[s][1]
+        voters.append((kind,user))
+    return tuple(voters)
+
+def expandTemplateName(pattern):
+    """
+    All the names matched by a pattern of the template lists,
+    these only use character classes and optional characters,
+    f.ex. '[Nn]eutral?' gives Neutral, Neutra, neutral and neutra.
+    """
+    names = [u'']
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == '[':
+            end = pattern.index(']',i)
+            chars = pattern[i+1:end]
+            i = end + 1
+        else:
+            chars = pattern[i]
+            i += 1
+        if pattern[i:i+1] == '?':
+            chars += u'\0'
+            i += 1
+        names = [name + c.replace(u'\0',u'') for name in names for c in chars]
+    return names
+
+def benchmarkVotes():
+    """
+    Times the VoteMatcher against the old vote regexps on
+    generated pages that make the regexps backtrack.
+    """
+    pages = (("Unclosed votes on one line", lambda n: u"{{Support|" * n + u"\n"),
+             ("Closed votes on one line",   lambda n: u"{{Support|x}} {{Oppose}} " * n + u"\n"),
+             ("Votes on separate lines",    lambda n: u"* {{Support}} [[User:X|X]]\n" * n),
+             ("Blanks after the name",      lambda n: (u"{{Support" + u" " * 50) * n))
+
+    out("Page                           Size   Regexps (s)  Matcher (s)")
+    for name,page in pages:
+        for n in VoteBenchmarkSizes:
+            text = page(n)
+            start = time.time()
+            scanTokens(text,TemplateTokenR,(SupportR,OpposeR,NeutralR))
+            old = time.time() - start
+            start = time.time()
+            FPCVotes.scan(text)
+            new = time.time() - start
+            out("%-28s %7d  %11.4f  %11.4f" % (name,len(text),old,new))
 
 def findEndOfTemplate(text,template):
     """
@@ -1026,7 +3859,7 @@ def findEndOfTemplate(text,template):
     such that we can insert new text after it.
     Will return the position or 0 if not found.
     """
-    m = re.search(r"{{\s*%s" % template,text)
+    m = G_Patterns.compile(r"{{\s*%s" % template).search(text)
     if not m:
         return 0
 
@@ -1061,6 +3894,44 @@ def findEndOfTemplate(text,template):
     return 0
 
 # Data and regexps used by the bot
+# Pool sizes timed by -speedup
+SpeedupWorkers = (1, 2, 4, 8, 16)
+# The max number of titles in one API query
+ApiBatchSize = 50
+# Longest name of a vote template
+MaxVoteName = 40
+# Candidates handed out per process at a time with -procs, and lines in each part of the report
+RecountQueue = 8
+RecountTop   = 10
+# Bytes read from a compressed dump at a time
+DumpChunkSize = 1 << 16
+# Places to split each page at with -appendtest
+AppendTestSplits = 20
+# Pages smaller than this many characters are downloaded again instead of reading the diff
+DiffMinSize = 20000
+# Seconds between the checks for edits with -daemon
+DaemonPollSeconds = 60
+# Days the user info of voters is kept in the store
+UserInfoDays = 1
+# Edits and days since registration needed to vote
+MinVoterEdits = 50
+MinVoterAgeDays = 10
+# Sizes of the pages timed by -votetest
+VoteBenchmarkSizes = (500, 1000, 2000)
+# Number of patterns kept by the PatternCache
+PatternCacheSize = 512
+# Bump this when scanCandidate() changes, such that stored scans are not used
+ScanVersion = 5
+# Ask the servers to refuse our api requests if they are lagged by this many seconds
+MaxLag = 5
+# Times a lagged or refused read is retried
+MaxRetries = 5
+# Times an edit is redone on the current text after an edit conflict
+MaxEditConflicts = 3
+# Number of writes that may be made without waiting for the put throttle
+WriteBurst = 2
+# Format of the timestamps returned by the api
+TimestampFormat = "%Y-%m-%dT%H:%M:%SZ"
 Month  = { 1:'January', 2:'February', 3:'March', 4:'April', 5:'May', 6:'June', 7:'July', 8:'August', 9:'September', 10:'October', 11:'November', 12:'December' }
 
 
@@ -1086,7 +3957,21 @@ keep_templates    = (u'[Kk]eep',u'[Vv]k',u'[Mm]antener',u'[Gg]arder',u'維持',u
 # Used to remove the prefix and just print the file names
 # of the candidate titles.
 candPrefix = "Commons:Featured picture candidates/"
+# Prefix of the featured picture galleries
+GalleryPrefix = "Commons:Featured pictures/"
 PrefixR = re.compile("%s.*?([Ff]ile|[Ii]mage)?:" % candPrefix)
+FileNameR = re.compile("(%s.*?)([Ff]ile|[Ii]mage)" % candPrefix)
+HeaderR = re.compile(r'(===.*)(===)')
+
+# Used by filter_spans(), the image note is the one from the opening
+# up to the parameters, the end can't contain any braces
+FilterTokenR = re.compile(r'<s>|</s>|<!--|<nowiki>|{{\s*[Ii]mageNote\s*\|')
+ImageNoteEndR = re.compile(r'{{\s*[iI]mageNoteEnd[^{}]*}}')
+# Where filter_content() can start or stop removing text, see appendScan()
+FilterMarkR = re.compile(r'<s>|</s>|<!--|-->|<nowiki>|</nowiki>|{{\s*[Ii]mageNote')
+
+# What wikipattern() replaces, in this order, such that no replacement is replaced again
+WikiPatternTable = ( ('(','\\('), (')','\\)'), ('*','\\*'), ('_',' '), (' ','[ _]') )
 
 # Looks for result counts, an example of such a line is:
 # '''result:''' 3 support, 2 oppose, 0 neutral => not featured.
@@ -1113,6 +3998,9 @@ DelistCountedTemplateR  = re.compile(r'^.*{{\s*FPC-delist-results-ready-for-revi
 ReviewedTemplateR       = re.compile(r'^.*{{\s*FPC-results-reviewed.*}}.*$\n?',re.MULTILINE)
 DelistReviewedTemplateR = re.compile(r'^.*{{\s*FPC-delist-results-reviewed.*}}.*$\n?',re.MULTILINE)
 
+# Nominations marked to be left alone by the bot
+IgnoredR = re.compile(r'{{\s*FPC-closed-ignored.*}}')
+
 # Is whitespace allowed at the end ?
 SectionR = re.compile('^={1,4}.+={1,4}\s*$',re.MULTILINE)
 # Voting templates
@@ -1121,6 +4009,19 @@ OpposeR  = re.compile("{{\s*(?:%s)(\|.*)?\s*}}" % "|".join( oppose_templates),re
 NeutralR = re.compile("{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(neutral_templates),re.MULTILINE)
 DelistR  = re.compile("{{\s*(?:%s)(\|.*)?\s*}}" % "|".join( delist_templates),re.MULTILINE)
 KeepR    = re.compile("{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(   keep_templates),re.MULTILINE)
+# The vote regexps above are only used by -votetest now, the
+# votes are found by these
+FPCVotes    = VoteMatcher(support_templates,oppose_templates,neutral_templates)
+DelistVotes = VoteMatcher(delist_templates,keep_templates,neutral_templates)
+# A template start with the name and either the pipe (2) or the end of the template,
+# names are at most MaxVoteName characters and can't start with a blank
+VoteTemplateR = re.compile(r'{{\s*([^|{}\s][^|{}\n]{0,%d}?)(?:(\|)|\s*}})' % (MaxVoteName - 1))
+# The end of a template at the start of the next non blank line
+CloseBelowR = re.compile(r'\s*}}')
+# A signature, the user name (1) is the link to the user or talk page
+SignatureR = re.compile(r'\[\[\s*:?\s*[Uu]ser(?:[ _][Tt]alk)?\s*:\s*([^|\[\]/#\n]+)')
+# The timestamp ending a signature, f.ex. '12:00, 1 January 2012 (UTC)'
+SignatureTimeR = re.compile(r'\d\d:\d\d, \d{1,2} [^\W\d_]+ \d{4} \(UTC\)',re.UNICODE)
 # Finds if a withdraw template is used
 # This template has an optional string which we
 # must be able to detect after the pipe symbol
@@ -1133,21 +4034,89 @@ ImagesR = re.compile('\[\[((?:[Ff]ile|[Ii]mage):[^\|]+).*?\]\]')
 ImagesSizeR = re.compile(r'\|.*?(\d+)\s*px')
 # Find if there is a thumb parameter specified
 ImagesThumbR = re.compile(r'\|\s*thumb\b')
-# Finds the last image link on a page
-LastImageR = re.compile(r'(?s)(\[\[(?:[Ff]ile|[Ii]mage):[^\n]*\]\])(?!.*\[\[(?:[Ff]ile|[Ii]mage):)')
+# The files shown by the lines of the featured picture galleries,
+# both gallery lines and image links at the start of a line
+GalleryFileR = re.compile(r'^\s*\[?\[?\s*(?:[Ff]ile|[Ii]mage)\s*:\s*([^|\]\n]+?)\s*(?:[|\]]|$)',re.MULTILINE)
+
+# Image links, as opposed to the lines of a gallery
+GalleryLinkR = re.compile(r'\[\[\s*(?:[Ff]ile|[Ii]mage)\s*:')
+
+# The lines GalleryPage splits the pages at
+GallerySectionR = re.compile(r'^(=+)\s*(.*?)\s*\1\s*$')
+SectionNameR = re.compile(r'^{{{\s*\d+\s*\|\s*(.*?)\s*}}}$')
+# The opening and closing gallery tags, anywhere in a line
+GalleryTagR = re.compile(r'<(/?)gallery\b[^>]*>')
+
+# Positions where scanCandidate() tries its regexps, each of them
+# starts with one of these tokens. Lookaheads are used such that
+# overlapping tokens like '{{{' are all found.
+TemplateTokenR = re.compile(r'(?=\{\{)')
+PageTokenR     = re.compile(r"(?=\{\{|\[\[|'''result:''')|^(?==)",re.MULTILINE)
+
+# The names of the templates used on a page, f.ex. the candidates on a log
+TemplateNameR = re.compile(r'{{\s*([^{}|\n]+?)\s*(?:\||}})')
+
+# The cells of the rows of a diff given by action=compare, the line numbers and tags in them
+DiffCellR = re.compile(r'<td[^>]*?class="([^"]*)"[^>]*>(.*?)</td>',re.DOTALL)
+DiffLineR = re.compile(r'Line ([\d,]+):')
+DiffTagR  = re.compile(r'<[^>]*>')
+
+# The result of scanning a candidate page, see scanCandidate()
+CandidateScan = collections.namedtuple('CandidateScan',
+                                       ['empty',            # The page has no content
+                                        'pro','con','neu',  # Vote counts
+                                        'withdrawn','fpx','ignored',
+                                        'sections',         # Number of sections
+                                        'images',           # Tuples of (filename,size in px or None,thumb)
+                                        'existing',         # Previous results, see existingResult()
+                                        'counted','reviewed',
+                                        'verified',         # Groups of each verified result template
+                                        'voters'])          # (kind,user) of each vote, see attributeVotes()
 
 # Auto reply yes to all questions
 G_Auto = False
 # Auto answer no
 G_Dry = False
-# Use threads
-G_Threads = False
+# Number of threads to use, 0 to not use threads
+G_Threads = 0
 # Avoid timestamps in output
 G_LogNoTime = False
 # Pattern to match
 G_MatchPattern = ""
 # Flag that will be set to True if CTRL-C was pressed
 G_Abort = False
+# Output collected per thread, see write()
+G_Output = threading.local()
+# For the entities in diffs, see diffLine()
+G_Html = HTMLParser.HTMLParser()
+# Number of api reads to run at the same time, see concurrentMap()
+G_Concurrency = 1
+# When set edits of shared pages are collected here, see Candidate.edit()
+G_EditBatch = None
+# Text of all pages fetched during this run
+G_PageCache = PageCache()
+# Used for the batched API queries
+G_Api = WikiApi()
+# Schedules all reads and writes
+G_Scheduler = RequestScheduler()
+# What we remember between runs
+G_Store = Store(os.path.join(os.path.dirname(os.path.abspath(__file__)),"fpcbot.db"))
+# First and latest revisions of pages
+G_Revisions = RevisionInfo(G_Store)
+# Text of pages kept between runs
+G_PageStore = PageStore(G_Store)
+# Whether pages exist
+G_Exists = PageExistence()
+# Regexps built at run time
+G_Patterns = PatternCache(PatternCacheSize)
+# Steps of the parking procedure that are done
+G_Journal = ParkJournal(G_Store)
+# Featured picture galleries listing each file
+G_Galleries = GalleryIndex(G_Store)
+# Accounts of the voters
+G_Users = UserInfo(G_Store)
+# When the candidates have to be checked for closing again
+G_Deadlines = Deadlines(G_Store)
 
 def main(*args):
 
@@ -1161,11 +4130,17 @@ def main(*args):
     worked = False
     delist = False
     fpc    = False
+    feedPath = None
+    dumpPath = None
+    procs    = 0
+    months   = [(2009,1)]
     global G_Auto
     global G_Dry
     global G_Threads
     global G_LogNoTime
     global G_MatchPattern
+    global G_Concurrency
+    global G_EditBatch
 
     # First look for arguments that should be set for all operations
     i = 1
@@ -1179,7 +4154,11 @@ def main(*args):
             sys.argv.remove(arg)
             continue
         elif arg == '-threads':
-            G_Threads = True
+            G_Threads = config.max_external_links
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-threads:'):
+            G_Threads = int(arg[len('-threads:'):])
             sys.argv.remove(arg)
             continue
         elif arg == '-delist':
@@ -1194,6 +4173,42 @@ def main(*args):
             G_LogNoTime = True
             sys.argv.remove(arg)
             continue
+        elif arg.startswith('-api:'):
+            G_Api.url = arg[len('-api:'):]
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-concurrency:'):
+            G_Concurrency = int(arg[len('-concurrency:'):])
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-feed:'):
+            feedPath = arg[len('-feed:'):]
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-dump:'):
+            dumpPath = arg[len('-dump:'):]
+            sys.argv.remove(arg)
+            continue
+        elif arg == '-procs':
+            procs = multiprocessing.cpu_count()
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-procs:'):
+            procs = int(arg[len('-procs:'):])
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-months:'):
+            try:
+                months = monthRange(arg[len('-months:'):])
+            except ValueError:
+                out("Warning - '-months' needs a range like 2009-01:2012-12, aborting.", color="lightred")
+                sys.exit(0)
+            sys.argv.remove(arg)
+            continue
+        elif arg.startswith('-store:'):
+            G_Store.path = arg[len('-store:'):]
+            sys.argv.remove(arg)
+            continue
         elif arg == '-match':
             if i+1 < len(sys.argv):
                 G_MatchPattern = sys.argv.pop(i+1)
@@ -1213,39 +4228,78 @@ def main(*args):
         out("Warning - '-threads' must be run with '-dry' or '-auto'", color="lightred")
         sys.exit(0)
 
+    # Nobody is there to answer when running as a daemon
+    if '-daemon' in sys.argv and (not G_Dry and not G_Auto):
+        out("Warning - '-daemon' must be run with '-dry' or '-auto'", color="lightred")
+        sys.exit(0)
+
     args = pywikibot.handleArgs(*args)
 
     # Abort on unknown arguments
     for arg in args:
-        if arg not in ['-test', '-close', '-info', '-park', '-threads', '-fpc', '-delist', '-help', '-notime', '-match', '-auto']:
+        if arg not in ['-test', '-close', '-info', '-park', '-threads', '-fpc', '-delist', '-help', '-notime', '-match', '-auto', '-speedup', '-buildindex', '-votetest', '-daemon', '-next', '-appendtest']:
             out("Warning - unknown argument '%s' aborting, see -help." % arg, color="lightred")
             sys.exit(0)
 
+    # Edits to shared pages are done once per page at the end
+    G_EditBatch = EditBatch()
+
     for arg in args:
         worked = True
         if arg == '-test':
             if delist:
                 out("-test not supported for delisting candidates")
-            if fpc:
-                checkCandidates(Candidate.compareResultToCount,testLog,delist=False)
+            if fpc and procs:
+                out("Recounting in %d processes..." % procs, color="lightblue")
+                recountCandidates(dumpCandidates(dumpPath,months) if dumpPath else storedCandidates(),procs)
+            elif fpc and dumpPath:
+                checkDump(Candidate.compareResultToCount,dumpPath,months)
+            elif fpc:
+                checkCandidates(Candidate.compareResultToCount,testLog,delist=False,history=False)
         elif arg == '-close':
             if delist:
                 out("Closing delist candidates...", color="lightblue")
-                checkCandidates(Candidate.closePage,delistPage,delist=True);
+                checkCandidates(Candidate.closePage,delistPage,delist=True,voters=True,deadlines=True);
             if fpc:
                 out("Closing fpc candidates...", color="lightblue")
-                checkCandidates(Candidate.closePage,fpcPage,delist=False);
+                checkCandidates(Candidate.closePage,fpcPage,delist=False,voters=True,deadlines=True);
         elif arg == '-info':
             if delist:
                 out("Gathering info about delist candidates...", color="lightblue")
-                checkCandidates(Candidate.printAllInfo,delistPage,delist=True);
+                checkCandidates(Candidate.printAllInfo,delistPage,delist=True,voters=True);
             if fpc:
                 out("Gathering info about fpc candidates...", color="lightblue")
-                checkCandidates(Candidate.printAllInfo,fpcPage,delist=False);
+                checkCandidates(Candidate.printAllInfo,fpcPage,delist=False,voters=True);
+        elif arg == '-speedup':
+            if delist:
+                out("Timing info about delist candidates...", color="lightblue")
+                measureSpeedup(delistPage,delist=True)
+            if fpc:
+                out("Timing info about fpc candidates...", color="lightblue")
+                measureSpeedup(fpcPage,delist=False)
+        elif arg == '-votetest':
+            if fpc:
+                checkCandidates(Candidate.compareVoteMatcher,testLog,delist=False,history=False)
+            benchmarkVotes()
+        elif arg == '-daemon':
+            lists = []
+            if delist:
+                lists.append((delistPage,True))
+            if fpc:
+                lists.append((fpcPage,False))
+            feed = FileFeed(feedPath) if feedPath else RecentChanges()
+            out("Closing and parking candidates as they change...", color="lightblue")
+            Daemon(feed,lists).run()
+        elif arg == '-appendtest':
+            if fpc:
+                checkCandidates(Candidate.compareAppendScan,testLog,delist=False,history=False)
+            checkAppendScans()
+        elif arg == '-next':
+            G_Deadlines.listing()
+        elif arg == '-buildindex':
+            out("Indexing the featured picture galleries...", color="lightblue")
+            G_Galleries.build()
         elif arg == '-park':
-            if G_Threads and G_Auto:
-                out("Auto parking using threads is disabled for now...", color="lightyellow")
-                sys.exit(0)
             if delist:
                 out("Parking delist candidates...", color="lightblue")
                 checkCandidates(Candidate.park,delistPage,delist=True);
@@ -1253,8 +4307,16 @@ def main(*args):
                 out("Parking fpc candidates...", color="lightblue")
                 checkCandidates(Candidate.park,fpcPage,delist=False);
 
+    G_EditBatch.flush()
+    G_Journal.report()
+
     if not worked:
         out("Warning - you need to specify an argument, see -help.", color="lightred")
+    else:
+        G_PageCache.report()
+        G_PageStore.report()
+        G_Scheduler.report()
+        G_Patterns.report()
 
 def signal_handler(signal, frame):
     global G_Abort